@@ -0,0 +1,60 @@
+import numpy as np
+from collections import (OrderedDict, namedtuple)
+from functools import (update_wrapper)
+from autograd.tracer import (isbox)
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+class FrameCache:
+    ''' Bounded LRU cache of frame operators F(x) or G(x), keyed on the frame
+        parameters x rounded to the given number of decimals.
+        Calls with autograd-traced parameters bypass the cache, so gradients
+        are unaffected.
+    '''
+    def __init__(self, fun, maxsize=1024, decimals=12):
+        update_wrapper(self, fun)
+        self.fun = fun
+        self.maxsize = maxsize
+        self.decimals = decimals
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __call__(self, x):
+        if isbox(x) or any(isbox(xi) for xi in x):
+            return self.fun(x)
+
+        key = tuple(np.round(np.asarray(x, dtype=float), self.decimals))
+        if key in self.cache:
+            self.hits += 1
+            self.cache.move_to_end(key)
+            return self.cache[key]
+
+        self.misses += 1
+        frame = self.fun(x)
+        frame.flags.writeable = False
+        self.cache[key] = frame
+        if len(self.cache) > self.maxsize:
+            self.cache.popitem(last=False)
+        return frame
+
+    def __reduce__(self):
+        # Pickle by reference to the module-level frame function, e.g. to
+        # send a PhaseSpace to worker processes without its cache.
+        return self.__qualname__
+
+    def cache_info(self):
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self.cache))
+
+    def cache_clear(self):
+        self.cache.clear()
+        self.hits = 0
+        self.misses = 0
+
+def frame_cache(fun=None, maxsize=1024, decimals=12):
+    ''' Decorator wrapping a frame function in a FrameCache, used either as
+        @frame_cache or @frame_cache(maxsize=..., decimals=...).
+    '''
+    if fun is None:
+        return lambda f: FrameCache(f, maxsize, decimals)
+    return FrameCache(fun, maxsize, decimals)
@@ -0,0 +1,77 @@
+import os
+import json
+import hashlib
+import numpy as np
+from itertools import (permutations)
+
+def gate_fingerprint(gate, n, decimals=6):
+    ''' Returns a fingerprint of an n-qudit gate which is invariant under a
+        global phase and under permutations of the qudits the gate acts on,
+        up to rounding to the given number of decimals. Among all qudit
+        permutations, the one giving the lexicographically smallest rounded
+        gate is taken as canonical.
+        Output - (fingerprint string, canonical permutation), where qudit k of
+                 the canonical gate is qudit perm[k] of the given one
+    '''
+    DIM = int(round(len(gate)**(1./n)))
+    U = np.reshape(gate, (DIM,)*(2*n))
+    best = None
+    for perm in permutations(range(n)):
+        U_perm = np.reshape(np.transpose(U, list(perm)+[n+p for p in perm]),
+                            (DIM**n, DIM**n)).flatten()
+        pivot = U_perm[np.argmax(np.abs(U_perm) > 10**(-decimals))]
+        U_perm = U_perm*np.conj(pivot)/np.abs(pivot)
+        key = np.round(np.concatenate([U_perm.real, U_perm.imag]), decimals)
+        key = (key + 0.).tobytes()
+        if best is None or key < best[0]:
+            best = (key, perm)
+    fingerprint = hashlib.sha1(bytes([n, DIM]) + best[0]).hexdigest()
+    return fingerprint, np.array(best[1])
+
+def load_frame_library(path):
+    ''' Returns the frame library stored at path, or an empty library if
+        there is none. A library maps gate fingerprints to
+        {'x_in': ..., 'x_out': ..., 'neg': ...}, the input/output frame
+        parameters (in canonical qudit order) with which the gate reached
+        the negativity neg. Libraries are specific to one frame.
+    '''
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as f:
+        return json.load(f)
+
+def save_frame_library(library, path):
+    ''' Writes the frame library to path, replacing any previous file only
+        once the new one is complete.
+    '''
+    with open(path + '.tmp', 'w') as f:
+        json.dump(library, f)
+    os.replace(path + '.tmp', path)
+
+def lookup_frame_library(library, gate, n, decimals=6):
+    ''' Returns the input and output frame parameters stored for the gate,
+        in the gate's own qudit order, or None if it is not in the library.
+        Output - ((n,len(x0)) ndarray, (n,len(x0)) ndarray) or None
+    '''
+    fingerprint, perm = gate_fingerprint(gate, n, decimals)
+    if fingerprint not in library:
+        return None
+    entry = library[fingerprint]
+    x_in = np.empty((n, len(entry['x_in'][0])))
+    x_out = np.empty((n, len(entry['x_out'][0])))
+    x_in[perm] = entry['x_in']
+    x_out[perm] = entry['x_out']
+    return x_in, x_out
+
+def update_frame_library(library, gate, n, x_in, x_out, neg, decimals=6):
+    ''' Records the frame parameters x_in, x_out (in the gate's own qudit
+        order) with which the gate has negativity neg, unless the library
+        already holds parameters of lower negativity for it.
+    '''
+    fingerprint, perm = gate_fingerprint(gate, n, decimals)
+    if fingerprint in library and library[fingerprint]['neg'] <= neg:
+        return library
+    library[fingerprint] = {'x_in': np.asarray(x_in)[perm].tolist(),
+                            'x_out': np.asarray(x_out)[perm].tolist(),
+                            'neg': float(neg)}
+    return library
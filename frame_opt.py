@@ -1,16 +1,33 @@
 import autograd.numpy as np
-from autograd import(grad)
-from scipy.optimize import(basinhopping)
-
-def init_x_list(circuit, x0):
+import numpy as onp
+from autograd import(grad, value_and_grad)
+from autograd.tracer import(isbox)
+from scipy.optimize import(basinhopping, minimize)
+from multiprocessing import(Pool)
+from frame_library import(lookup_frame_library, update_frame_library)
+from phase_space import(get_arity_groups)
+
+def init_x_list(circuit, x0, library=None, W=None):
+    ''' Returns the frame parameters of the circuit, one per wire segment,
+        as a dict with
+        'x_list'         - (num_wires,len(x0)) float array, x_list[x_idx]
+                           gives parameter x
+        'x_index_gate'   - x_index_gate[gate_index] = [array([x1_in_idx,...]),
+                                                       array([x1_out_idx,...])]
+        'x_index_meas'   - x_index_meas[meas_index] = x_idx
+        and the wire adjacency, giving for each x_idx the element producing
+        or consuming it (-1 if none):
+        'producer_state', 'producer_gate', 'consumer_gate', 'consumer_meas'.
+        If a frame library (frame_library.load_frame_library) is given, the
+        wires are then seeded from it with seed_x_list, which needs the
+        phase space functions W to score the stored parameters.
+    '''
+    if library is not None and W is None:
+        raise Exception('W must be given to seed x_list from a library')
     N = len(circuit['state_list'])
-    x_list = []
     x_index_gate = []
     x_index_meas = []
 
-    for q_index in range(N):
-        x_list.append(x0)
-
     running_idx = np.arange(N)
     idx_end = N-1
 
@@ -22,71 +39,145 @@ def init_x_list(circuit, x0):
         for q_index in q_index_list:
             x_idx_in.append(running_idx[q_index])
 
-            x_list.append(x0)
             idx_end = idx_end + 1
             x_idx_out.append(idx_end)
             running_idx[q_index] = idx_end
 
-        x_index_gate.append([x_idx_in,x_idx_out])
+        x_index_gate.append([np.array(x_idx_in, dtype=int),
+                             np.array(x_idx_out, dtype=int)])
     x_index_meas = running_idx
-    return [x_list, x_index_gate, x_index_meas]
-# x_index[gate_index] = [[x1_in_idx,x2_in_idx,...],
-#                         [x1_out_idx,x2_out_idx,...]]
-# x_list[x_idx] gives parameter x
+    x_list = np.tile(np.array(x0, dtype=float), (idx_end+1, 1))
+
+    producer_state = -np.ones(len(x_list), dtype=int)
+    producer_gate = -np.ones(len(x_list), dtype=int)
+    consumer_gate = -np.ones(len(x_list), dtype=int)
+    consumer_meas = -np.ones(len(x_list), dtype=int)
+    producer_state[:N] = np.arange(N)
+    for j in range(len(x_index_gate)):
+        consumer_gate[x_index_gate[j][0]] = j
+        producer_gate[x_index_gate[j][1]] = j
+    consumer_meas[x_index_meas] = np.arange(len(x_index_meas))
+
+    x_circuit = {'x_list': x_list, 'x_index_gate': x_index_gate,
+                 'x_index_meas': x_index_meas,
+                 'producer_state': producer_state,
+                 'producer_gate': producer_gate,
+                 'consumer_gate': consumer_gate,
+                 'consumer_meas': consumer_meas}
+    if library is not None:
+        x_circuit = seed_x_list(W, circuit, x_circuit, library)
+    return x_circuit
+
+def seed_x_list(W,circuit,x_circuit,library):
+    ''' Returns x_circuit with the wires of the gates found in the frame
+        library set to their stored parameters. Stored parameters are tried
+        gate by gate and kept only if they lower the log-negativity of the
+        gate and its neighbouring elements, so the seeded circuit is never
+        more negative than the initial one.
+    '''
+    x_list = x_circuit['x_list'].copy()
+    x_index_gate = x_circuit['x_index_gate']
+    for j in range(len(x_index_gate)):
+        [x_idx_in, x_idx_out] = x_index_gate[j]
+        x_stored = lookup_frame_library(library, circuit['gate_list'][j],
+                                        len(x_idx_in))
+        if x_stored is None:
+            continue
+        target_circuit_index = [
+          [int(i) for i in x_circuit['producer_state'][x_idx_in] if i >= 0],
+          sorted(set([j] + [int(i) for i in np.concatenate([
+            x_circuit['producer_gate'][x_idx_in],
+            x_circuit['consumer_gate'][x_idx_out]]) if i >= 0])),
+          [int(i) for i in x_circuit['consumer_meas'][x_idx_out] if i >= 0]]
+        x_seeded = x_list.copy()
+        x_seeded[x_idx_in] = x_stored[0]
+        x_seeded[x_idx_out] = x_stored[1]
+        log_neg = [get_log_negativity_block(W, circuit,
+                     dict(x_circuit, x_list=x), target_circuit_index)
+                   for x in [x_list, x_seeded]]
+        if log_neg[1] < log_neg[0]:
+            x_list = x_seeded
+    return dict(x_circuit, x_list=x_list)
+
+def record_frame_library(library,W,circuit,x_circuit):
+    ''' Records the frame parameters of every gate of the circuit, together
+        with the gate negativity they give, in the frame library, keeping
+        for each gate fingerprint the parameters of lowest negativity.
+    '''
+    x_list = x_circuit['x_list']
+    x_index_gate = x_circuit['x_index_gate']
+    gate_index = np.arange(len(circuit['gate_list']))
+    log_neg = get_log_negativity_list(W, circuit, x_circuit,
+                                      [[], gate_index, []])[1]
+    for j in gate_index:
+        [x_idx_in, x_idx_out] = x_index_gate[j]
+        update_frame_library(library, circuit['gate_list'][j], len(x_idx_in),
+                             x_list[x_idx_in], x_list[x_idx_out],
+                             np.exp(log_neg[j]))
+    return library
 
 def get_connected_index(x_circuit,target_circuit_index):
-    [x_list, x_index_gate, x_index_meas] = x_circuit
+    ''' Returns the indices of the parameters on the wires joining two
+        elements of the block: state-gate wires, then gate-gate wires, then
+        gate-measurement wires, each ordered by the elements' positions in
+        target_circuit_index.
+    '''
+    x_index_gate = x_circuit['x_index_gate']
+    consumer_gate = x_circuit['consumer_gate']
+    consumer_meas = x_circuit['consumer_meas']
     [target_state_index, target_gate_index, target_meas_index
      ] = target_circuit_index
 
-    idx_connect = []
+    gate_pos = {j: k for k, j in enumerate(target_gate_index)}
+    meas_pos = {j: k for k, j in enumerate(target_meas_index)}
 
-    for i in target_state_index:
-        for j in target_gate_index:
-            idx_connect = idx_connect + np.ndarray.tolist(np.intersect1d([i],
-              x_index_gate[j][0]).flatten())
+    idx_connect = [i for i in target_state_index
+                   if consumer_gate[i] in gate_pos]
 
     for i in target_gate_index:
-        for j in target_gate_index:
-            if i != j:
-                idx_connect = idx_connect + np.ndarray.tolist(np.intersect1d(
-                  x_index_gate[i][1],x_index_gate[j][0]).flatten())
+        idx_connect += [idx for _, idx in sorted(
+          (gate_pos[consumer_gate[idx]], idx) for idx in x_index_gate[i][1]
+          if consumer_gate[idx] in gate_pos)]
 
     for i in target_gate_index:
-        for j in target_meas_index:
-            idx_connect = idx_connect + np.ndarray.tolist(np.intersect1d(
-              x_index_gate[i][1],x_index_meas[j]).flatten())
+        idx_connect += [idx for _, idx in sorted(
+          (meas_pos[consumer_meas[idx]], idx) for idx in x_index_gate[i][1]
+          if consumer_meas[idx] in meas_pos)]
 
-    return idx_connect
+    return [int(idx) for idx in idx_connect]
 
 def replace_x_list(x_list,x_list_target,idx_connect):
+    ''' Returns x_list with the rows idx_connect replaced by x_list_target,
+        as a single fancy-index scatter. If x_list_target is traced by
+        autograd, the rows are returned as an object array instead, so that
+        the fixed rows stay untraced and their frames remain cached.
+    '''
+    x_list_target = np.reshape(x_list_target, (len(idx_connect),-1))
+    if isbox(x_list_target):
+        x_list_out = onp.fromiter(x_list, dtype=object, count=len(x_list))
+        for i, idx in enumerate(idx_connect):
+            x_list_out[idx] = x_list_target[i]
+        return x_list_out
     x_list_out = x_list.copy()
-    i=0
-    for idx in idx_connect:
-        x_list_out[idx] = x_list_target[i]
-        i += 1
+    x_list_out[idx_connect] = x_list_target
     return x_list_out
 
 def get_target_circuit_block(x_circuit,x_target_index):
-    [x_list, x_index_gate, x_index_meas] = x_circuit
-    target_state_index = []
-    target_gate_index = []
-    target_meas_index = []
-
-    qubit_num = len(x_index_meas)
-    for idx in range(qubit_num):
-        if (idx in x_target_index):
-            target_state_index.append(idx)
-    for idx in range(len(x_index_gate)):
-        if set(np.array(x_index_gate[idx]).flatten()).intersection(
-                x_target_index):
-            target_gate_index.append(idx)
-    for idx in range(qubit_num):
-        if (x_index_meas[idx] in x_target_index):
-            target_meas_index.append(idx)
-
-    target_circuit_index = [target_state_index,target_gate_index,
-                            target_meas_index]
+    ''' Returns the states, gates and measurements producing or consuming
+        any of the parameters in x_target_index, each in increasing order.
+    '''
+    target_state_index = set()
+    target_gate_index = set()
+    target_meas_index = set()
+    for idx in x_target_index:
+        target_state_index.add(x_circuit['producer_state'][idx])
+        target_gate_index.add(x_circuit['producer_gate'][idx])
+        target_gate_index.add(x_circuit['consumer_gate'][idx])
+        target_meas_index.add(x_circuit['consumer_meas'][idx])
+
+    target_circuit_index = [sorted(int(i) for i in index if i >= 0) for index
+                            in [target_state_index,target_gate_index,
+                                target_meas_index]]
     return target_circuit_index
 
 def neg_gate_max(W_gate, gate, par_list_in, par_list_out):
@@ -95,33 +186,220 @@ def neg_gate_max(W_gate, gate, par_list_in, par_list_out):
                   np.arange(2*n,4*n))).max()
 #     return np.abs(W_gate(gate, par_list_in, par_list_out)).sum(axis=0).max()
 
+def get_neg_gate_fun(W_gate, x0, DIM=2):
+    ''' Returns the function gate -> neg_gate_max(W_gate, gate, ...) with
+        every frame at x0, cached per gate, e.g. for the negativity-aware
+        mode of compression.compress_circuit.
+    '''
+    cache = {}
+    def neg_fun(gate):
+        gate = onp.ascontiguousarray(gate, dtype="complex_")
+        key = gate.tobytes()
+        if key not in cache:
+            n = int(round(onp.log(len(gate))/onp.log(DIM)))
+            cache[key] = neg_gate_max(W_gate, gate, n*[x0], n*[x0])
+        return cache[key]
+    return neg_fun
+
+def neg_gate_max_batch(W_gate_batch, gates, par_batch_in, par_batch_out):
+    ''' Returns neg_gate_max for each gate in a stack of equal-arity gates.
+    '''
+    n = len(par_batch_out[0])
+    neg = np.abs(W_gate_batch(gates, par_batch_in, par_batch_out)).sum(
+                 axis=tuple(np.arange(2*n+1,4*n+1)))
+    return np.reshape(neg, (len(gates),-1)).max(axis=1)
+
 
 def get_negativity_block(W,circuit,x_circuit,target_circuit_index):
-    W_state = W[0]
-    W_gate = W[1]
-    W_meas = W[2]
+    ''' Returns the block negativity, the product of the negativities of its
+        elements, as the exponential of get_log_negativity_block.
+    '''
+    return np.exp(get_log_negativity_block(W, circuit, x_circuit,
+                                           target_circuit_index))
+
+def get_negativity_block_grad(dW,circuit,x_circuit,target_circuit_index):
+    ''' Returns the block negativity of get_negativity_block together with its
+        gradient with respect to every parameter in x_list, assembled from the
+        analytic element gradients of get_log_negativity_block_grad:
+        d neg = neg d log(neg).
+        Output - (neg, (len(x_list),len(x0)) ndarray)
+    '''
+    log_neg, log_grad = get_log_negativity_block_grad(dW, circuit, x_circuit,
+                                                      target_circuit_index)
+    neg = np.exp(log_neg)
+    return neg, neg*log_grad
+
+def get_log_negativity_block_grad(dW,circuit,x_circuit,target_circuit_index):
+    ''' Returns the block log-negativity together with its gradient with
+        respect to every parameter in x_list, assembled sparsely from the
+        analytic element gradients dW = [dW_state, dW_gate, dW_meas,
+        dW_gate_batch] of PhaseSpace: each element adds d neg_e/neg_e to the
+        rows of its own wires only. Gates are evaluated in one dW_gate_batch
+        call per arity.
+        Output - (log_neg, (len(x_list),len(x0)) ndarray)
+    '''
+    dW_state = dW[0]
+    dW_meas = dW[2]
+    dW_gate_batch = dW[3]
 
     state_list = circuit['state_list']
     gate_list = circuit['gate_list']
     meas_list = circuit['meas_list']
 
-    [x_list, x_index_gate, x_index_meas] = x_circuit
+    x_list = x_circuit['x_list']
+    x_index_gate = x_circuit['x_index_gate']
+    x_index_meas = x_circuit['x_index_meas']
     [target_state_index,target_gate_index,target_meas_index
      ] = target_circuit_index
 
-    neg = 1
+    log_neg = 0
+    log_grad = np.zeros(np.shape(x_list))
     for state_index in target_state_index:
         x = x_list[state_index]
-        neg *= np.abs(W_state(state_list[state_index], x)).sum()
-    for gate_index in target_gate_index:
-        [x_idx_in, x_idx_out] = x_index_gate[gate_index]
-        x_in = [x_list[x_idx] for x_idx in x_idx_in]
-        x_out = [x_list[x_idx] for x_idx in x_idx_out]
-        neg *= neg_gate_max(W_gate, gate_list[gate_index], x_in, x_out)
+        neg_e, grad_e = dW_state(state_list[state_index], x)
+        log_neg += np.log(neg_e)
+        log_grad[state_index] += grad_e/neg_e
+    for group in get_arity_groups(circuit['index_list'],
+                                  target_gate_index).values():
+        group = [target_gate_index[i] for i in group]
+        gates = np.stack([gate_list[gate_index] for gate_index in group])
+        x_idx_in = np.array([x_index_gate[gate_index][0]
+                             for gate_index in group])
+        x_idx_out = np.array([x_index_gate[gate_index][1]
+                              for gate_index in group])
+        neg_e, grad_in, grad_out = dW_gate_batch(gates, x_list[x_idx_in],
+                                                 x_list[x_idx_out])
+        log_neg += np.sum(np.log(neg_e))
+        ## A wire may leave one gate of the group and enter another.
+        onp.add.at(log_grad, x_idx_in, grad_in/neg_e[:,None,None])
+        onp.add.at(log_grad, x_idx_out, grad_out/neg_e[:,None,None])
     for meas_index in target_meas_index:
-        x = x_list[x_index_meas[meas_index]]
-        neg *= np.abs(W_meas(meas_list[meas_index], x)).max()
-    return neg
+        x_idx = x_index_meas[meas_index]
+        neg_e, grad_e = dW_meas(meas_list[meas_index], x_list[x_idx])
+        log_neg += np.log(neg_e)
+        log_grad[x_idx] += grad_e/neg_e
+    return log_neg, log_grad
+
+def log_soft_max(x, beta, axis=-1):
+    ''' Returns the smooth surrogate (1/beta) log sum_i x_i^beta of
+        log max_i x_i for non-negative x, i.e. a log-sum-exp soft maximum of
+        log x. It exceeds log max x by at most log(len(x))/beta.
+    '''
+    x_max = np.max(x, axis=axis, keepdims=True)
+    return np.log(np.max(x, axis=axis)) + np.log(np.sum((x/x_max)**beta,
+                                                        axis=axis))/beta
+
+def get_log_negativity_block(W,circuit,x_circuit,target_circuit_index,
+                             beta=None):
+    ''' Returns the log of the block negativity of get_negativity_block,
+        accumulated as a sum of per-element log-negativities
+        (get_log_negativity_list) so that long blocks do not underflow or
+        overflow. If beta is given, the maxima of the gate and measurement
+        terms are replaced by log_soft_max(., beta).
+    '''
+    log_neg_list = get_log_negativity_list(W, circuit, x_circuit,
+                                           target_circuit_index, beta)
+    return sum(np.sum(log_neg) for log_neg in log_neg_list)
+
+def split_block(x_circuit,target_circuit_index,idx_connect):
+    ''' Splits the block into the elements touching a parameter in
+        idx_connect and the remaining ones, whose negativities do not change
+        while the parameters in idx_connect are optimised.
+        Output - (active target_circuit_index, fixed target_circuit_index)
+    '''
+    x_index_gate = x_circuit['x_index_gate']
+    x_index_meas = x_circuit['x_index_meas']
+    [target_state_index,target_gate_index,target_meas_index
+     ] = target_circuit_index
+    idx_connect = set(idx_connect)
+
+    is_active = [[i in idx_connect for i in target_state_index],
+                 [bool(idx_connect.intersection(np.concatenate(
+                                                x_index_gate[i])))
+                  for i in target_gate_index],
+                 [x_index_meas[i] in idx_connect for i in target_meas_index]]
+    active = [[i for i, a in zip(index, act) if a]
+              for index, act in zip(target_circuit_index, is_active)]
+    fixed = [[i for i, a in zip(index, act) if not a]
+             for index, act in zip(target_circuit_index, is_active)]
+    return active, fixed
+
+def get_log_negativity_list(W,circuit,x_circuit,target_circuit_index,
+                            beta=None):
+    ''' Returns the log-negativities of the elements of the block as a list of
+        three arrays, for the target states, gates and measurements in the
+        order of target_circuit_index. Their total is the block
+        log-negativity. States and measurements are evaluated in one batch
+        each and gates in one batch per arity (get_arity_groups). If beta is
+        given, the maxima of the gate and measurement terms are replaced by
+        log_soft_max(., beta). The result can be traced by autograd.
+    '''
+    W_gate_batch = W[3]
+    W_state_batch = W[4]
+    W_meas_batch = W[5]
+
+    x_list = x_circuit['x_list']
+    x_index_gate = x_circuit['x_index_gate']
+    x_index_meas = x_circuit['x_index_meas']
+    [target_state_index,target_gate_index,target_meas_index
+     ] = target_circuit_index
+
+    log_neg_list = [np.zeros(0), np.zeros(0), np.zeros(0)]
+    if len(target_state_index):
+        states = np.stack([circuit['state_list'][state_index]
+                           for state_index in target_state_index])
+        x = x_list[np.array(target_state_index)]
+        log_neg_list[0] = np.log(np.abs(W_state_batch(states, x)).sum(
+                                        axis=(1,2)))
+    if len(target_gate_index):
+        log_neg_groups, order = [], []
+        for n, group in get_arity_groups(circuit['index_list'],
+                                         target_gate_index).items():
+            gates = np.stack([circuit['gate_list'][target_gate_index[i]]
+                              for i in group])
+            x_in = x_list[np.array([x_index_gate[target_gate_index[i]][0]
+                                    for i in group])]
+            x_out = x_list[np.array([x_index_gate[target_gate_index[i]][1]
+                                     for i in group])]
+            row_neg = np.reshape(np.abs(W_gate_batch(gates, x_in, x_out)).sum(
+                        axis=tuple(np.arange(2*n+1,4*n+1))), (len(group),-1))
+            if beta is None:
+                log_neg_groups.append(np.log(row_neg.max(axis=1)))
+            else:
+                log_neg_groups.append(log_soft_max(row_neg, beta))
+            order += group
+        log_neg_list[1] = np.concatenate(log_neg_groups)[onp.argsort(order)]
+    if len(target_meas_index):
+        meas = np.stack([circuit['meas_list'][meas_index]
+                         for meas_index in target_meas_index])
+        x = x_list[np.array([x_index_meas[meas_index]
+                             for meas_index in target_meas_index])]
+        W_abs = np.abs(np.reshape(W_meas_batch(meas, x),
+                                  (len(target_meas_index),-1)))
+        if beta is None:
+            log_neg_list[2] = np.log(W_abs.max(axis=1))
+        else:
+            log_neg_list[2] = log_soft_max(W_abs, beta)
+    return log_neg_list
+
+def update_log_negativity_list(log_neg_list,W,circuit,x_circuit,
+                               target_circuit_index):
+    ''' Returns the circuit log-negativity list of get_log_negativity_list
+        with only the elements in target_circuit_index re-evaluated, e.g. those
+        touching the parameters changed by a block optimisation.
+    '''
+    log_neg_block = get_log_negativity_list(W, circuit, x_circuit,
+                                            target_circuit_index)
+    log_neg_list = [log_neg.copy() for log_neg in log_neg_list]
+    for k in range(3):
+        log_neg_list[k][np.array(target_circuit_index[k], dtype=int)
+                        ] = log_neg_block[k]
+    return log_neg_list
+
+def get_negativity_list_total(log_neg_list):
+    ''' Returns the negativity corresponding to a log-negativity list.
+    '''
+    return np.exp(sum(np.sum(log_neg) for log_neg in log_neg_list))
 
 def get_negativity_circuit(W,circuit,x_circuit):
     target_circuit_index = [np.arange(len(circuit['state_list'])),
@@ -130,34 +408,73 @@ def get_negativity_circuit(W,circuit,x_circuit):
     return get_negativity_block(W,circuit,x_circuit,target_circuit_index)
 
 def opt_negativity_block(W,circuit,x_circuit,target_circuit_index,niter=3,
-                         show_log=False):
-    [x_list, x_index_gate, x_index_meas] = x_circuit
+                         show_log=False,dW=None,beta=None,seed=None):
+    ''' Optimises the frame parameters on the wires connecting the elements
+        of the block. If dW = PhaseSpace.dW is given, the gradient is evaluated
+        analytically with get_negativity_block_grad instead of with autograd.
+        If beta is given, the smooth surrogate get_log_negativity_block(...,
+        beta) of the block log-negativity is minimised instead, with
+        autograd. Its terms from elements not touching the optimised
+        parameters are evaluated once and kept fixed. The analytic gradients
+        are those of the hard maximum, so dW and beta cannot be given
+        together.
+        seed - seed of the basinhopping steps (the global numpy random
+               state if None)
+    '''
+    if dW is not None and beta is not None:
+        raise Exception('beta is not supported with the analytic gradient dW')
+    x_list = x_circuit['x_list']
     idx_connect = get_connected_index(x_circuit,target_circuit_index)
-    len_x = len(x_list[0])
-
-    def cost_function(x):
-        x_list_target = np.reshape(x,(-1,len_x))
-        x_replaced_list = replace_x_list(x_list, x_list_target, idx_connect)
-        x_replaced_circuit = [x_replaced_list, x_index_gate, x_index_meas]
-        return get_negativity_block(W, circuit, x_replaced_circuit,
-                                    target_circuit_index)
-
-    grad_cost_function = grad(cost_function)
-    def func(x):
-        return cost_function(x), grad_cost_function(x)
+    len_x = x_list.shape[1]
+
+    if beta is None:
+        def cost_function(x):
+            x_list_target = np.reshape(x,(-1,len_x))
+            x_replaced_list = replace_x_list(x_list, x_list_target,
+                                             idx_connect)
+            x_replaced_circuit = dict(x_circuit, x_list=x_replaced_list)
+            return get_negativity_block(W, circuit, x_replaced_circuit,
+                                        target_circuit_index)
+    else:
+        active_index, fixed_index = split_block(x_circuit,
+                                      target_circuit_index, idx_connect)
+        log_neg_fixed = get_log_negativity_block(W, circuit, x_circuit,
+                                                 fixed_index, beta)
+        def cost_function(x):
+            x_list_target = np.reshape(x,(-1,len_x))
+            x_replaced_list = replace_x_list(x_list, x_list_target,
+                                             idx_connect)
+            x_replaced_circuit = dict(x_circuit, x_list=x_replaced_list)
+            return log_neg_fixed + get_log_negativity_block(W, circuit,
+                     x_replaced_circuit, active_index, beta)
+
+    if dW is None:
+        grad_cost_function = grad(cost_function)
+        def func(x):
+            return cost_function(x), grad_cost_function(x)
+    else:
+        def func(x):
+            x_list_target = np.reshape(x,(-1,len_x))
+            x_replaced_list = replace_x_list(x_list, x_list_target,
+                                             idx_connect)
+            x_replaced_circuit = dict(x_circuit, x_list=x_replaced_list)
+            neg, neg_grad = get_negativity_block_grad(dW, circuit,
+                              x_replaced_circuit, target_circuit_index)
+            return neg, neg_grad[idx_connect].flatten()
 
     if len(idx_connect)==0:
         ## If there is no connected wire, we don't need to optimise anything.
         return x_circuit
     else:
         ## Optimise
-        x_ref_list = [x_list[idx] for idx in idx_connect]
+        x_ref_list = x_list[idx_connect].flatten()
 
         optimise_result = basinhopping(func, x_ref_list,
-          minimizer_kwargs={"method":"L-BFGS-B", "jac":True}, niter=niter)
+          minimizer_kwargs={"method":"L-BFGS-B", "jac":True}, niter=niter,
+          seed=seed)
         x_list_target_opt = np.reshape(optimise_result.x,(-1,len_x))
         x_list_all_opt = replace_x_list(x_list,x_list_target_opt,idx_connect)
-        x_circuit_opt = [x_list_all_opt,x_index_gate, x_index_meas]
+        x_circuit_opt = dict(x_circuit, x_list=x_list_all_opt)
 
         if show_log==True:
             neg_init = get_negativity_circuit(W,circuit,x_circuit)
@@ -170,7 +487,7 @@ def opt_negativity_block(W,circuit,x_circuit,target_circuit_index,niter=3,
         return x_circuit_opt
 
 def random_circuit_opt(W, circuit, x_circuit, l_state=2, l_gate=5, l_meas=2,
-                       niter=3, show_log=False):
+                       niter=3, show_log=False, dW=None, beta=None):
     target_state_index = np.random.choice(np.arange(
                            len(circuit['state_list'])),l_state,replace=False)
     target_gate_index = np.random.choice(np.arange(len(circuit['gate_list'])),
@@ -180,70 +497,321 @@ def random_circuit_opt(W, circuit, x_circuit, l_state=2, l_gate=5, l_meas=2,
 
     target_circuit_index = [target_state_index,target_gate_index,
                             target_meas_index]
-    idx_connect = get_connected_index(x_circuit,target_circuit_index)
 
-    get_negativity_block(W,circuit,x_circuit,target_circuit_index)
     x_circuit_out = opt_negativity_block(W, circuit, x_circuit,
-                                         target_circuit_index,niter=niter)
+                                         target_circuit_index,niter=niter,
+                                         dW=dW,beta=beta)
     neg_out = get_negativity_circuit(W,circuit,x_circuit_out)
 
     return x_circuit_out, neg_out
 
-def random_para_opt(W,circuit,x_circuit,l=3,niter=3,show_log=False):
-    neg_init = get_negativity_circuit(W,circuit,x_circuit)
+def random_para_opt(W,circuit,x_circuit,l=3,niter=3,show_log=False,
+                    dW=None,beta=None):
+    circuit_index = [np.arange(len(circuit['state_list'])),
+                     np.arange(len(circuit['gate_list'])),
+                     np.arange(len(circuit['meas_list']))]
+    log_neg_list = get_log_negativity_list(W,circuit,x_circuit,circuit_index)
+    neg_init = get_negativity_list_total(log_neg_list)
     if show_log == True:
-        print('Initial parameters\n',np.real(x_circuit[0]))
+        print('Initial parameters\n',np.real(x_circuit['x_list']))
         print('Initial log-negativity:\t', np.log(neg_init))
 
     neg_list = [neg_init]
     itr_count = 0
 
-    x_range = np.arange(len(x_circuit[0]))
+    x_range = np.arange(len(x_circuit['x_list']))
     np.random.shuffle(x_range)
 
     x_circuit_out = x_circuit
 
-    for x_init_idx in range(int(len(x_circuit[0])/l)):
-#     for x_init_idx in range(len(x_circuit[0])):
+    x_num = len(x_circuit['x_list'])
+    for x_init_idx in range(int(x_num/l)):
+#     for x_init_idx in range(x_num):
         x_target_index = x_range[l*x_init_idx:np.min([l*(x_init_idx + 1),
-                                                      len(x_circuit[0])])]
+                                                      x_num])]
         # x_target_index = x_range[x_init_idx:np.min([x_init_idx + l,
-        #                                             len(x_circuit[0])])]
+        #                                             x_num])]
         target_circuit_index = get_target_circuit_block(x_circuit_out,
                                                         x_target_index)
         idx_connect = get_connected_index(x_circuit_out, target_circuit_index)
 
-        get_negativity_block(W,circuit,x_circuit_out,target_circuit_index)
         x_circuit_out = opt_negativity_block(W,circuit,x_circuit_out,
-                                             target_circuit_index,niter=niter)
-        neg_out = get_negativity_circuit(W,circuit,x_circuit_out)
+                                             target_circuit_index,niter=niter,
+                                             dW=dW,beta=beta)
+        active_index = split_block(x_circuit_out, target_circuit_index,
+                                   idx_connect)[0]
+        log_neg_list = update_log_negativity_list(log_neg_list, W, circuit,
+                                                  x_circuit_out, active_index)
+        neg_out = get_negativity_list_total(log_neg_list)
         if show_log == True:
             print('Optimized log-negativity:\t', np.log(neg_out))
         neg_list.append(neg_out)
     return x_circuit_out, neg_list
 
-def sequential_para_opt(W, circuit, x_circuit, l=3, niter=3, show_log=False):
-    neg_init = get_negativity_circuit(W,circuit,x_circuit)
+def sequential_para_opt(W, circuit, x_circuit, l=3, niter=3, show_log=False,
+                        dW=None, beta=None):
+    circuit_index = [np.arange(len(circuit['state_list'])),
+                     np.arange(len(circuit['gate_list'])),
+                     np.arange(len(circuit['meas_list']))]
+    log_neg_list = get_log_negativity_list(W,circuit,x_circuit,circuit_index)
+    neg_init = get_negativity_list_total(log_neg_list)
     if show_log == True:
-        print('Initial parameters\n',np.real(x_circuit[0]))
+        print('Initial parameters\n',np.real(x_circuit['x_list']))
         print('Initial log-negativity:\t', np.log(neg_init))
 
     neg_list = [neg_init]
     itr_count = 0
 
     x_circuit_out = x_circuit
-    for x_init_idx in range(len(x_circuit[0])):
+    x_num = len(x_circuit['x_list'])
+    for x_init_idx in range(x_num):
         x_target_index = np.arange(x_init_idx,np.min([x_init_idx + l,
-                                                      len(x_circuit[0])]))
+                                                      x_num]))
         target_circuit_index = get_target_circuit_block(x_circuit_out,
                                                         x_target_index)
         idx_connect = get_connected_index(x_circuit_out, target_circuit_index)
 
-        get_negativity_block(W,circuit,x_circuit_out,target_circuit_index)
         x_circuit_out = opt_negativity_block(W, circuit, x_circuit_out,
-                                             target_circuit_index,niter=niter)
-        neg_out = get_negativity_circuit(W, circuit, x_circuit_out)
+                                             target_circuit_index,niter=niter,
+                                             dW=dW,beta=beta)
+        active_index = split_block(x_circuit_out, target_circuit_index,
+                                   idx_connect)[0]
+        log_neg_list = update_log_negativity_list(log_neg_list, W, circuit,
+                                                  x_circuit_out, active_index)
+        neg_out = get_negativity_list_total(log_neg_list)
         if show_log == True:
             print('Optimized log-negativity:\t', np.log(neg_out))
         neg_list.append(neg_out)
     return x_circuit_out, neg_list
+
+def global_para_opt(W, circuit, x_circuit, maxiter=1000, show_log=False,
+                    dW=None, beta=None, beta_schedule=None):
+    ''' Optimises all frame parameters of the circuit at once, in a single
+        L-BFGS-B run on the circuit log-negativity. The gradient is assembled
+        sparsely from the analytic element gradients if dW = PhaseSpace.dW is
+        given (get_log_negativity_block_grad), and otherwise obtained with
+        autograd from one batched evaluation of get_log_negativity_block,
+        which uses the smooth surrogate if beta is given. The analytic
+        gradients are those of the hard maximum, so dW and beta cannot be
+        given together.
+        If beta_schedule (increasing betas) is given, this is a continuation
+        instead: the surrogate is minimised for each beta in turn, with at
+        most maxiter iterations each, and the result is polished with the
+        hard maximum (using dW if given).
+        The circuit log-negativity (with the hard maximum) is recorded
+        instead of the negativity, which overflows for long circuits.
+        Output - (x_circuit_out, log_neg_list with one entry per iteration)
+
+        This does not replace the block sweeps. L-BFGS-B stalls on the kinks
+        of the hard maximum, and at x0 the gradient of Clifford+T circuits
+        can vanish altogether. On compressed generate_random_CliffT(4,20,4)
+        circuits (n=2, Wigner frame) one sequential_para_opt(l=2, niter=1)
+        sweep reached log-negativities 2.84/2.10/0.40, against 3.69/4.40/1.11
+        for this function and 3.35/3.60/0.69 with beta_schedule=[2,4,8,16,
+        32,64] and maxiter=200 (about 35 s per circuit against 14 s for the
+        sweep). Started from the output of a sweep, it does not improve it
+        further.
+    '''
+    if dW is not None and beta is not None:
+        raise Exception('beta is not supported with the analytic gradient dW')
+    if beta_schedule is not None:
+        if beta is not None:
+            raise Exception('Give either beta or beta_schedule')
+        log_neg_list = []
+        for beta_k in list(beta_schedule) + [None]:
+            x_circuit, log_neg_stage = global_para_opt(W, circuit, x_circuit,
+                maxiter, show_log, dW=dW if beta_k is None else None,
+                beta=beta_k)
+            log_neg_list += log_neg_stage[len(log_neg_list)>0:]
+        return x_circuit, log_neg_list
+    circuit_index = [np.arange(len(circuit['state_list'])),
+                     np.arange(len(circuit['gate_list'])),
+                     np.arange(len(circuit['meas_list']))]
+    x_shape = x_circuit['x_list'].shape
+
+    def cost_function(x):
+        x_replaced_circuit = dict(x_circuit, x_list=np.reshape(x, x_shape))
+        return get_log_negativity_block(W, circuit, x_replaced_circuit,
+                                        circuit_index, beta)
+
+    last_eval = {}
+    if dW is None:
+        value_and_grad_cost_function = value_and_grad(cost_function)
+        def func(x):
+            log_neg, log_grad = value_and_grad_cost_function(x)
+            last_eval.update(x=x.copy(), log_neg=log_neg)
+            return log_neg, log_grad
+    else:
+        def func(x):
+            x_replaced_circuit = dict(x_circuit, x_list=np.reshape(x, x_shape))
+            log_neg, log_grad = get_log_negativity_block_grad(dW, circuit,
+                                  x_replaced_circuit, circuit_index)
+            last_eval.update(x=x.copy(), log_neg=log_neg)
+            return log_neg, log_grad.flatten()
+
+    log_neg_init = get_log_negativity_block(W, circuit, x_circuit,
+                                            circuit_index)
+    if show_log == True:
+        print('Initial log-negativity:\t', log_neg_init)
+    log_neg_list = [log_neg_init]
+
+    def callback(x):
+        ## The hard-max objective at x was usually the last one evaluated.
+        if beta is None and np.array_equal(x, last_eval['x']):
+            log_neg_list.append(last_eval['log_neg'])
+        else:
+            x_circuit_x = dict(x_circuit, x_list=np.reshape(x, x_shape))
+            log_neg_list.append(get_log_negativity_block(W, circuit,
+                                  x_circuit_x, circuit_index))
+        if show_log == True:
+            print('Optimized log-negativity:\t', log_neg_list[-1])
+
+    optimise_result = minimize(func, x_circuit['x_list'].flatten(),
+                               method='L-BFGS-B', jac=True, callback=callback,
+                               options={'maxiter': maxiter})
+    x_circuit_out = dict(x_circuit, x_list=np.reshape(optimise_result.x,
+                                                      x_shape))
+    return x_circuit_out, log_neg_list
+
+def get_block_colouring(block_list):
+    ''' Greedily colours the blocks, in order, so that blocks sharing a state,
+        gate or measurement get different colours. Blocks of one colour then
+        touch disjoint elements, hence also disjoint connected parameters,
+        and can be optimised independently.
+        block_list - list of target_circuit_index
+        Output - list of colours
+    '''
+    colours = []
+    element_colours = {}
+    for block in block_list:
+        elements = [(k, int(i)) for k in range(3) for i in block[k]]
+        used = set()
+        for element in elements:
+            used.update(element_colours.get(element, ()))
+        colour = 0
+        while colour in used:
+            colour += 1
+        colours.append(colour)
+        for element in elements:
+            element_colours.setdefault(element, set()).add(colour)
+    return colours
+
+def get_block_wire_index(x_circuit,target_circuit_index):
+    ''' Returns the indices of all parameters read when evaluating the
+        block, i.e. the wires of its states, gates and measurements.
+    '''
+    [target_state_index, target_gate_index, target_meas_index
+     ] = target_circuit_index
+    x_index_gate = x_circuit['x_index_gate']
+    wire_index = [np.array(target_state_index, dtype=int),
+                  x_circuit['x_index_meas'][np.array(target_meas_index,
+                                                     dtype=int)]]
+    for j in target_gate_index:
+        wire_index += x_index_gate[j]
+    return onp.unique(onp.concatenate(wire_index))
+
+pool_context = {}
+
+def init_pool_context(W, circuit, x_circuit, block_list, niter, dW, beta):
+    ''' Stores the arguments shared by every block optimisation of
+        parallel_para_opt, once per worker process. The worker keeps its own
+        copy of x_list, whose rows are refreshed by each task.
+    '''
+    x_circuit = dict(x_circuit, x_list=x_circuit['x_list'].copy())
+    pool_context.update(W=W, circuit=circuit, x_circuit=x_circuit,
+                        block_list=block_list, niter=niter, dW=dW, beta=beta)
+
+def opt_block_task(task):
+    ''' Optimises one block of parallel_para_opt in a worker process.
+        task - (block number, current parameters of its wires, seed)
+        Output - optimised parameters of the block's idx_connect
+    '''
+    b, x_wires, seed = task
+    target_circuit_index, idx_connect, wire_index = pool_context[
+                                                      'block_list'][b]
+    x_circuit = pool_context['x_circuit']
+    x_circuit['x_list'][wire_index] = x_wires
+    x_circuit_opt = opt_negativity_block(pool_context['W'],
+                      pool_context['circuit'], x_circuit,
+                      target_circuit_index, niter=pool_context['niter'],
+                      dW=pool_context['dW'], beta=pool_context['beta'],
+                      seed=seed)
+    return x_circuit_opt['x_list'][idx_connect]
+
+def parallel_para_opt(W, circuit, x_circuit, l=3, niter=3, show_log=False,
+                      dW=None, beta=None, n_workers=None):
+    ''' Optimises the blocks of sequential_para_opt, scheduled by colour
+        (get_block_colouring) instead of one after another: the blocks of one
+        colour are independent, so they are optimised in parallel on a pool
+        of n_workers processes (os.cpu_count() if None; in-process if 1) and
+        merged back into x_list before the next colour.
+        Output - (x_circuit_out, neg_list with one entry per colour)
+    '''
+    if dW is not None and beta is not None:
+        raise Exception('beta is not supported with the analytic gradient dW')
+    circuit_index = [np.arange(len(circuit['state_list'])),
+                     np.arange(len(circuit['gate_list'])),
+                     np.arange(len(circuit['meas_list']))]
+    log_neg_list = get_log_negativity_list(W,circuit,x_circuit,circuit_index)
+    neg_init = get_negativity_list_total(log_neg_list)
+    if show_log == True:
+        print('Initial parameters\n',np.real(x_circuit['x_list']))
+        print('Initial log-negativity:\t', np.log(neg_init))
+
+    neg_list = [neg_init]
+
+    block_list = []
+    x_num = len(x_circuit['x_list'])
+    for x_init_idx in range(x_num):
+        x_target_index = np.arange(x_init_idx,np.min([x_init_idx + l,
+                                                      x_num]))
+        target_circuit_index = get_target_circuit_block(x_circuit,
+                                                        x_target_index)
+        idx_connect = get_connected_index(x_circuit, target_circuit_index)
+        if len(idx_connect) > 0:
+            block_list.append([target_circuit_index, idx_connect,
+              get_block_wire_index(x_circuit, target_circuit_index)])
+    colours = get_block_colouring([block[0] for block in block_list])
+    seeds = np.random.randint(2**31, size=len(block_list))
+
+    ## Workers receive the circuit once and, per task, only the rows of
+    ## x_list read by the block.
+    pool = None
+    initargs = (W, circuit, x_circuit, block_list, niter, dW, beta)
+    if n_workers == 1 or len(block_list) == 0:
+        init_pool_context(*initargs)
+        pool_map = map
+    else:
+        pool = Pool(n_workers, initializer=init_pool_context,
+                    initargs=initargs)
+        pool_map = pool.map
+
+    x_circuit_out = x_circuit
+    try:
+        for colour in range(max(colours, default=-1)+1):
+            group = [b for b in range(len(block_list)) if colours[b]==colour]
+            tasks = [(b, x_circuit_out['x_list'][block_list[b][2]],
+                      seeds[b]) for b in group]
+            x_list = x_circuit_out['x_list'].copy()
+            active_index = [[],[],[]]
+            for b, x_opt in zip(group, pool_map(opt_block_task, tasks)):
+                [target_circuit_index, idx_connect] = block_list[b][:2]
+                x_list[idx_connect] = x_opt
+                active = split_block(x_circuit_out, target_circuit_index,
+                                     idx_connect)[0]
+                for k in range(3):
+                    active_index[k] += active[k]
+            x_circuit_out = dict(x_circuit_out, x_list=x_list)
+
+            log_neg_list = update_log_negativity_list(log_neg_list, W,
+                             circuit, x_circuit_out, active_index)
+            neg_out = get_negativity_list_total(log_neg_list)
+            if show_log == True:
+                print('Optimized log-negativity:\t', np.log(neg_out))
+            neg_list.append(neg_out)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        pool_context.clear()
+    return x_circuit_out, neg_list
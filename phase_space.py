@@ -1,112 +1,446 @@
 import autograd.numpy as np
+import numpy as onp
+from functools import (lru_cache)
+from autograd.tracer import (isbox)
 
 class PhaseSpace:
-    def __init__(self, F_fun, G_fun, x0, DIM):
+    def __init__(self, F_fun, G_fun, x0, DIM, dF_fun=None, dG_fun=None,
+                 bloch_funs=None):
+        ''' bloch_funs - optional [F_bloch, G_bloch, dF_bloch, dG_bloch] of a
+                         qubit frame, giving the frames (and their derivatives)
+                         in the Pauli basis. If given, single-qubit states and
+                         measurements are evaluated in closed form from them.
+        '''
         self.DIM = DIM
         self.x0 = x0
 
         self.F = F_fun
         self.G = G_fun
-        self.W = [self.W_state, self.W_gate, self.W_meas]
+        self.W = [self.W_state, self.W_gate, self.W_meas, self.W_gate_batch,
+                  self.W_state_batch, self.W_meas_batch]
+
+        self.dF = dF_fun
+        self.dG = dG_fun
+        self.dW = [self.dW_state, self.dW_gate, self.dW_meas,
+                   self.dW_gate_batch]
+
+        [self.F_bloch, self.G_bloch, self.dF_bloch, self.dG_bloch
+         ] = bloch_funs if bloch_funs is not None else [None]*4
 
     def W_state(self, state, x):
+        if self.F_bloch is not None:
+            return contract_bloch(self.F_bloch(stack_rows(x)), state)
         DIM = self.DIM
         F1q = self.F(x)
         return np.real(np.einsum('ijkl,lk->ij', F1q, state))
 
+    def W_state_batch(self, states, x_batch):
+        ''' Returns the quasi-probability distributions of a stack of states.
+            With Pauli-basis frames this is a single broadcast product;
+            otherwise the states are evaluated one by one.
+            states  - (B,DIM,DIM) ndarray
+            x_batch - (B,len(x0)) array-like
+            Output - (B,DIM,DIM) real ndarray
+        '''
+        if self.F_bloch is not None:
+            return contract_bloch(self.F_bloch(stack_rows(x_batch)), states)
+        return np.array([self.W_state(state, x)
+                         for state, x in zip(states, x_batch)])
+
     def W_gate(self, gate, x_in_list, x_out_list):
+        ''' Returns the quasi-probability tensor of an n-qudit gate,
+            W[in_1, ..., in_n, out_1, ..., out_n] = tr[U G_in U^\dagger F_out],
+            where each in_k, out_k stands for a pair of phase space indices.
+            The per-qudit frames are contracted directly with the gate along
+            a cached contraction path, so the joint n-qudit G_in/F_out
+            tensors are never formed.
+            Output - (DIM,)*(4n) real ndarray
+        '''
         DIM = self.DIM
-        if len(x_in_list)==1:
-            G_in = self.G(x_in_list[0])
-            F_out = self.F(x_out_list[0])
-            U_ev = np.einsum('lk,ijkn,mn->ijlm', gate, G_in, gate.conj())
-            return np.real(np.einsum('ijkl,mnlk->ijmn', U_ev, F_out))
-
-        if len(x_in_list)==2:
-            G_in1 = self.G(x_in_list[0])
-            G_in2 = self.G(x_in_list[1])
-
-            F_out1 = self.F(x_out_list[0])
-            F_out2 = self.F(x_out_list[1])
-
-            G_in = np.einsum('ijkl,mnrs->ijmnkrls',
-                     G_in1, G_in2).reshape(
-                     (DIM,DIM,DIM,DIM,DIM*DIM,DIM*DIM))
-            F_out = np.einsum('ijkl,mnrs->ijmnkrls',
-                      F_out1, F_out2).reshape(
-                      (DIM,DIM,DIM,DIM,DIM*DIM,DIM*DIM))
-            U_ev = np.einsum('lk,ijsrkn,mn->ijsrlm',
-                             gate, G_in, gate.conj())
-            return np.real(np.einsum('ijsrkl,mnablk->ijsrmnab',U_ev, F_out))
-
-        if len(x_in_list)==3:
-            G_in1 = self.G(x_in_list[0])
-            G_in2 = self.G(x_in_list[1])
-            G_in3 = self.G(x_in_list[2])
-
-            F_out1 = self.F(x_out_list[0])
-            F_out2 = self.F(x_out_list[1])
-            F_out3 = self.F(x_out_list[2])
-
-            G_in = np.einsum('ijkl,mnrs,xyzw->ijmnxykrzlsw',
-                     G_in1, G_in2, G_in3).reshape(
-                     (DIM,DIM,DIM,DIM,DIM,DIM,DIM*DIM*DIM,DIM*DIM*DIM))
-            F_out = np.einsum('ijkl,mnrs,xyzw->ijmnxykrzlsw',
-                      F_out1, F_out2, F_out3).reshape(
-                      (DIM,DIM,DIM,DIM,DIM,DIM,DIM*DIM*DIM,DIM*DIM*DIM))
-            U_ev = np.einsum('lk,ijsrxykn,mn->ijsrxylm',
-                             gate, G_in, gate.conj())
-            return np.real(np.einsum('ijsrxykl,mnabzwlk->ijsrxymnabzw',
-                                     U_ev, F_out))
-
-        if len(x_in_list)==4:
-            G_in1 = self.G(x_in_list[0])
-            G_in2 = self.G(x_in_list[1])
-            G_in3 = self.G(x_in_list[2])
-            G_in4 = self.G(x_in_list[3])
-
-            F_out1 = self.F(x_out_list[0])
-            F_out2 = self.F(x_out_list[1])
-            F_out3 = self.F(x_out_list[2])
-            F_out4 = self.F(x_out_list[3])
-
-            G_in = np.einsum('ijkl,mnrs,xyzw,abcd->ijmnxyabkrzclswd',
-                     G_in1, G_in2, G_in3, G_in4).reshape(
-                     (DIM,DIM,DIM,DIM,DIM,DIM,DIM,DIM,DIM**4,DIM**4))
-            F_out = np.einsum('ijkl,mnrs,xyzw,abcd->ijmnxyabkrzclswd',
-                      F_out1,F_out2,F_out3,F_out4).reshape(
-                      (DIM,DIM,DIM,DIM,DIM,DIM,DIM,DIM,DIM**4,DIM**4))
-            U_ev = np.einsum('lk,ijsrxyabkn,mn->ijsrxyablm',
-                             gate, G_in, gate.conj())
-            return np.real(np.einsum(
-                           'ijsrxycdkl,mnabzweflk->ijsrxycdmnabzwef',
-                           U_ev, F_out))
-
-        if len(x_in_list)==5:
-            G_in1 = self.G(x_in_list[0])
-            G_in2 = self.G(x_in_list[1])
-            G_in3 = self.G(x_in_list[2])
-            G_in4 = self.G(x_in_list[3])
-            G_in5 = self.G(x_in_list[4])
-
-            F_out1 = self.F(x_out_list[0])
-            F_out2 = self.F(x_out_list[1])
-            F_out3 = self.F(x_out_list[2])
-            F_out4 = self.F(x_out_list[3])
-            F_out5 = self.F(x_out_list[4])
-
-            G_in = np.einsum('abkp,cdlq,efmr,ghns,ijot->abcdefghijklmnopqrst',
-                     G_in1,G_in2,G_in3,G_in4,G_in5).reshape(
-                     (DIM,DIM,DIM,DIM,DIM,DIM,DIM,DIM,DIM,DIM,DIM**5,DIM**5))
-            F_out = np.einsum('abkp,cdlq,efmr,ghns,ijot->abcdefghijklmnopqrst',
-                      F_out1,F_out2,F_out3,F_out4,F_out5).reshape(
-                      (DIM,DIM,DIM,DIM,DIM,DIM,DIM,DIM,DIM,DIM,DIM**5,DIM**5))
-            U_ev = np.einsum('ml,abcdefghijlk,nk->abcdefghijmn',
-                             gate, G_in, gate.conj())
-            return np.real(np.einsum(
-                           'abcdefghijuv,klmnopqrstvu->abcdefghijklmnopqrst',
-                           U_ev, F_out))
+        n = len(x_in_list)
+
+        if n > 1 and get_gate_factors(gate, n, DIM) is not None:
+            return self.W_gate_batch(np.array([gate]), [x_in_list],
+                                     [x_out_list])[0]
+
+        U = np.reshape(gate, (DIM,)*(2*n))
+        G_list = [np.reshape(self.G(x), (DIM*DIM,DIM,DIM))
+                  for x in x_in_list]
+        F_list = [np.reshape(self.F(x), (DIM*DIM,DIM,DIM))
+                  for x in x_out_list]
+
+        operands = [U] + G_list + [np.conj(U)] + F_list
+        steps, perm = get_contraction_path(n, DIM)
+        for (i, j), axes in steps:
+            a, b = operands[i], operands[j]
+            for p in sorted((i, j), reverse=True):
+                del operands[p]
+            operands.append(np.tensordot(a, b, axes))
+        W = np.transpose(np.real(operands[0]), perm)
+        return np.reshape(W, (DIM,)*(4*n))
+
+    def W_gate_batch(self, gates, x_in_batch, x_out_batch, chunk=2**20):
+        ''' Returns the quasi-probability tensors of a stack of n-qudit gates,
+            evaluated along the same contraction path as W_gate with a leading
+            batch axis. Gates are processed in slices of at most chunk
+            tensor entries to bound the size of the intermediates.
+            Gates that are Kronecker products of 1-qudit gates (see
+            get_gate_factors) have product quasi-probability tensors; these
+            are assembled from the 1-qudit tensors of their factors.
+            gates       - (B,DIM**n,DIM**n) ndarray
+            x_in_batch  - (B,n,len(x0)) array-like
+            x_out_batch - (B,n,len(x0)) array-like
+            Output - (B,)+(DIM,)*(4n) real ndarray
+        '''
+        DIM = self.DIM
+        B, n = len(x_in_batch), len(x_in_batch[0])
+
+        factors = [get_gate_factors(gate, n, DIM) if n > 1 else None
+                   for gate in gates]
+        prod = [b for b in range(B) if factors[b] is not None]
+        if prod:
+            W1q = self.W_gate_batch(np.concatenate([factors[b] for b in prod]),
+                                    [[x] for b in prod for x in x_in_batch[b]],
+                                    [[x] for b in prod for x in x_out_batch[b]],
+                                    chunk)
+            W = get_product_W(np.reshape(W1q, (len(prod),n)+(DIM,)*4))
+            if len(prod) == B:
+                return W
+            rest = [b for b in range(B) if factors[b] is None]
+            W_rest = self.W_gate_batch(gates[rest],
+                                       [x_in_batch[b] for b in rest],
+                                       [x_out_batch[b] for b in rest], chunk)
+            return np.concatenate([W, W_rest])[onp.argsort(prod+rest)]
+
+        step = max(1, chunk//DIM**(4*n))
+        steps, perm = get_contraction_path(n, DIM)
+
+        W_list = []
+        for b0 in range(0, B, step):
+            U = np.reshape(gates[b0:b0+step], (-1,)+(DIM,)*(2*n))
+            G_all = np.reshape(np.array([self.G(x) for xs in
+                                x_in_batch[b0:b0+step] for x in xs]),
+                               (-1,n,DIM*DIM,DIM,DIM))
+            F_all = np.reshape(np.array([self.F(x) for xs in
+                                x_out_batch[b0:b0+step] for x in xs]),
+                               (-1,n,DIM*DIM,DIM,DIM))
+
+            operands = [U] + [G_all[:,k] for k in range(n)] + [np.conj(U)]
+            operands += [F_all[:,k] for k in range(n)]
+            for (i, j), axes in steps:
+                a, b = operands[i], operands[j]
+                for p in sorted((i, j), reverse=True):
+                    del operands[p]
+                operands.append(batch_tensordot(a, b, axes))
+            W = np.transpose(np.real(operands[0]), [0]+[p+1 for p in perm])
+            W_list.append(np.reshape(W, (-1,)+(DIM,)*(4*n)))
+        return W_list[0] if len(W_list)==1 else np.concatenate(W_list)
 
     def W_meas(self, meas, x):
+        if self.G_bloch is not None:
+            return contract_bloch(self.G_bloch(stack_rows(x)), meas)
         G1q = self.G(x)
-        return np.real(np.einsum('ijkl,lk->ij', G1q, meas))
\ No newline at end of file
+        return np.real(np.einsum('ijkl,lk->ij', G1q, meas))
+
+    def W_meas_batch(self, meas_batch, x_batch):
+        ''' Returns the quasi-probability distributions of a stack of
+            measurements, as W_state_batch.
+            Output - (B,DIM,DIM) real ndarray
+        '''
+        if self.G_bloch is not None:
+            return contract_bloch(self.G_bloch(stack_rows(x_batch)),
+                                  meas_batch)
+        return np.array([self.W_meas(meas, x)
+                         for meas, x in zip(meas_batch, x_batch)])
+
+    def dW_state(self, state, x):
+        ''' Returns the state negativity sum|W_state| together with its
+            gradient with respect to x.
+            Output - (neg, (len(x),) ndarray)
+        '''
+        W = self.W_state(state, x)
+        if self.dF_bloch is not None:
+            grad = onp.sum(contract_bloch(self.dF_bloch(stack_rows(x)), state)
+                           *onp.sign(W), axis=(1,2))
+            return onp.abs(W).sum(), grad
+        grad = onp.real(onp.einsum('aijkl,lk,ij->a', self.dF(x), state,
+                                   onp.sign(W)))
+        return onp.abs(W).sum(), grad
+
+    def dW_gate(self, gate, x_in_list, x_out_list):
+        ''' Returns the gate negativity max_in sum_out|W_gate| together with
+            its gradients with respect to x_in_list and x_out_list, as
+            dW_gate_batch for a single gate.
+            Output - (neg, (n,len(x)) ndarray, (n,len(x)) ndarray)
+        '''
+        neg, grad_in, grad_out = self.dW_gate_batch(onp.array([gate]),
+                                   [x_in_list], [x_out_list])
+        return neg[0], grad_in[0], grad_out[0]
+
+    def dW_gate_batch(self, gates, x_in_batch, x_out_batch, chunk=2**20):
+        ''' Returns the negativities max_in sum_out|W_gate| of a stack of
+            n-qudit gates together with their gradients with respect to the
+            input and output parameters.
+            The derivative of a gate negativity is that of
+            sum_{P,R} T[P,R] W_gate[P,R], where T holds the signs of W_gate
+            on the maximal rows, averaged over tied rows as autograd does,
+            and zero elsewhere. Attaching T to the network of W_gate and
+            contracting it around each frame in turn gives the derivative
+            with respect to that frame, once for all tied rows. The
+            contractions carry a leading batch axis and gates are processed
+            in slices of at most chunk tensor entries, as in W_gate_batch.
+            gates       - (B,DIM**n,DIM**n) ndarray
+            x_in_batch  - (B,n,len(x0)) array-like
+            x_out_batch - (B,n,len(x0)) array-like
+            Output - ((B,) ndarray, (B,n,len(x0)) ndarray,
+                      (B,n,len(x0)) ndarray)
+        '''
+        DIM = self.DIM
+        B, n = len(x_in_batch), len(x_in_batch[0])
+
+        W = onp.reshape(self.W_gate_batch(gates, x_in_batch, x_out_batch,
+                                          chunk), (B,DIM**(2*n),DIM**(2*n)))
+        row_neg = onp.abs(W).sum(axis=2)
+        neg = row_neg.max(axis=1)
+        mask = row_neg==neg[:,None]
+        T = onp.reshape(onp.sign(W)*(mask/mask.sum(axis=1)[:,None])[:,:,None],
+                        (B,)+(DIM*DIM,)*(2*n))
+
+        x_in = onp.reshape(onp.array(x_in_batch, dtype=float), (B*n,-1))
+        x_out = onp.reshape(onp.array(x_out_batch, dtype=float), (B*n,-1))
+        G_all = onp.reshape([self.G(x) for x in x_in], (B,n,DIM*DIM,DIM,DIM))
+        F_all = onp.reshape([self.F(x) for x in x_out], (B,n,DIM*DIM,DIM,DIM))
+        dG_all = onp.reshape([self.dG(x) for x in x_in],
+                             (B,n,-1,DIM*DIM*DIM*DIM))
+        dF_all = onp.reshape([self.dF(x) for x in x_out],
+                             (B,n,-1,DIM*DIM*DIM*DIM))
+
+        grad_in = onp.zeros((B,n,x_in.shape[1]))
+        grad_out = onp.zeros((B,n,x_out.shape[1]))
+        step = max(1, chunk//DIM**(4*n))
+        for b0 in range(0, B, step):
+            s = slice(b0, b0+step)
+            U = onp.reshape(gates[s], (-1,)+(DIM,)*(2*n))
+            operands = [U] + [G_all[s,k] for k in range(n)] + [onp.conj(U)]
+            operands += [F_all[s,k] for k in range(n)] + [T[s]]
+            for k in range(n):
+                E = onp.reshape(get_environment(operands, 1+k, batch=True),
+                                (len(U),-1,1))
+                grad_in[s,k] = onp.real(onp.matmul(dG_all[s,k], E))[...,0]
+                E = onp.reshape(get_environment(operands, n+2+k, batch=True),
+                                (len(U),-1,1))
+                grad_out[s,k] = onp.real(onp.matmul(dF_all[s,k], E))[...,0]
+        return neg, grad_in, grad_out
+
+    def dW_meas(self, meas, x):
+        ''' Returns the measurement negativity max|W_meas| together with its
+            gradient with respect to x. Tied entries are averaged.
+            Output - (neg, (len(x),) ndarray)
+        '''
+        W = self.W_meas(meas, x)
+        mask = onp.abs(W)==onp.abs(W).max()
+        if self.dG_bloch is not None:
+            grad = onp.sum(contract_bloch(self.dG_bloch(stack_rows(x)), meas)
+                           *onp.sign(W)*mask, axis=(1,2))
+            return onp.abs(W).max(), grad/mask.sum()
+        grad = onp.real(onp.einsum('aijkl,lk,ij->a', self.dG(x), meas,
+                                   onp.sign(W)*mask))
+        return onp.abs(W).max(), grad/mask.sum()
+
+def pauli_expectations(A):
+    ''' Returns the expectations tr[sigma_mu A] of the Pauli operators
+        (sigma_0 = 1) for 2x2 Hermitian A, over the last two axes of A.
+        Output - A.shape[:-2]+(4,) real ndarray
+    '''
+    A = onp.asarray(A)
+    a00, a01, a10, a11 = A[...,0,0], A[...,0,1], A[...,1,0], A[...,1,1]
+    return onp.real(onp.stack([a00+a11, a01+a10, 1.j*(a01-a10), a00-a11],
+                              axis=-1))
+
+def contract_bloch(frame_bloch, A):
+    ''' Returns tr[F_{ij} A] for a qubit frame given by its Pauli-basis
+        coefficients, F_{ij} = sum_mu f_{ij,mu} sigma_mu, and 2x2 Hermitian
+        A, broadcast over the leading axes of both.
+        frame_bloch - (...,DIM,DIM,4) real ndarray
+        A           - (...,2,2) ndarray
+        Output - (...,DIM,DIM) real ndarray
+    '''
+    e = pauli_expectations(A)
+    return np.sum(frame_bloch*e[...,None,None,:], axis=-1)
+
+def stack_rows(x):
+    ''' Returns frame parameters x as one array (or autograd box) with the
+        parameter on the last axis, stacking the rows of a list or object
+        array of rows such as the traced x_list of frame_opt.
+    '''
+    if isbox(x) or isinstance(x, onp.ndarray) and x.dtype != object:
+        return x
+    if any(isbox(xi) for xi in x):
+        return np.stack(list(x))
+    return onp.array(list(x), dtype=float)
+
+def get_arity_groups(index_list, gate_index=None):
+    ''' Returns the gates of each arity, for evaluating them together with
+        the batched functions of PhaseSpace (e.g. W_gate_batch).
+        index_list - qudit indices of every gate of the circuit
+        gate_index - gates to group (default: all), in order
+        Output - dict arity -> list of positions in gate_index, in order
+    '''
+    if gate_index is None:
+        gate_index = range(len(index_list))
+    arity_groups = {}
+    for i, g in enumerate(gate_index):
+        arity_groups.setdefault(len(index_list[g]), []).append(i)
+    return arity_groups
+
+def get_gate_factors(gate, n, DIM, tol=1e-10):
+    ''' Returns 1-qudit gates u_1, ..., u_n with gate = u_1 x ... x u_n
+        (Kronecker product), or None if the gate is entangling. The factors
+        are split off one qudit at a time by an operator-Schmidt rank test and
+        cached per gate.
+        Output - (n,DIM,DIM) complex ndarray or None
+    '''
+    gate = onp.ascontiguousarray(gate, dtype="complex_")
+    return find_gate_factors(gate.tobytes(), n, DIM, tol)
+
+@lru_cache(maxsize=1024)
+def find_gate_factors(gate_bytes, n, DIM, tol):
+    U = onp.frombuffer(gate_bytes, dtype="complex_")
+    factors = []
+    for k in range(n-1):
+        rest = DIM**(n-1-k)
+        U = onp.reshape(onp.transpose(onp.reshape(U, (DIM,rest,DIM,rest)),
+                                      (0,2,1,3)), (DIM*DIM, rest*rest))
+        u, s, vh = onp.linalg.svd(U, full_matrices=False)
+        if s[1] > tol*s[0]:
+            return None
+        factors.append(onp.reshape(u[:,0], (DIM,DIM))*onp.sqrt(DIM))
+        U = s[0]*vh[0]/onp.sqrt(DIM)
+    factors.append(onp.reshape(U, (DIM,DIM)))
+    factors = onp.array(factors)
+    factors.flags.writeable = False
+    return factors
+
+def get_product_W(W1q):
+    ''' Returns the quasi-probability tensors of product gates from those of
+        their 1-qudit factors, W[in_1, ..., in_n, out_1, ..., out_n]
+        = prod_k W_k[in_k, out_k].
+        W1q - (B,n,DIM,DIM,DIM,DIM) real ndarray
+        Output - (B,)+(DIM,)*(4n) real ndarray
+    '''
+    B, n, DIM = W1q.shape[0], W1q.shape[1], W1q.shape[2]
+    W1q = np.reshape(W1q, (B,n,DIM*DIM,DIM*DIM))
+    W = W1q[:,0]
+    for k in range(1, n):
+        W = np.reshape(W[:,:,None,:,None]*W1q[:,k,None,:,None,:],
+                       (B,DIM**(2*k+2),DIM**(2*k+2)))
+    return np.reshape(W, (B,)+(DIM,)*(4*n))
+
+def batch_tensordot(a, b, axes):
+    ''' Returns tensordot of a and b over the given axes, broadcast over their
+        common leading (batch) axis. axes index the non-batch axes of a, b.
+    '''
+    axes_a, axes_b = list(axes[0]), list(axes[1])
+    free_a = [i for i in range(len(a.shape)-1) if i not in axes_a]
+    free_b = [i for i in range(len(b.shape)-1) if i not in axes_b]
+    shape_free_a = [a.shape[i+1] for i in free_a]
+    shape_free_b = [b.shape[i+1] for i in free_b]
+    shared = int(onp.prod([a.shape[i+1] for i in axes_a]))
+
+    a_mat = np.reshape(np.transpose(a, [0]+[i+1 for i in free_a+axes_a]),
+                       (a.shape[0], -1, shared))
+    b_mat = np.reshape(np.transpose(b, [0]+[i+1 for i in axes_b+free_b]),
+                       (b.shape[0], shared, -1))
+    return np.reshape(np.matmul(a_mat, b_mat),
+                      [a.shape[0]]+shape_free_a+shape_free_b)
+
+def get_index_network(n):
+    ''' Returns the index labels of the tensor network evaluated by W_gate
+        for an n-qudit gate. Labels are
+            l_k = k,    k_k = n+k   (rows, columns of U),
+            m_k = 2n+k, c_k = 3n+k  (rows, columns of U^*),
+            P_k = 4n+k, R_k = 5n+k  (input, output phase space points),
+        and the network reads U[l,k] G_k[P_k,k_k,c_k] U^*[m,c] F_k[R_k,m_k,l_k].
+        Output - (list of operand label lists, output label list)
+    '''
+    labels = [list(range(0,n)) + list(range(n,2*n))]
+    labels += [[4*n+k, n+k, 3*n+k] for k in range(n)]
+    labels += [list(range(2*n,3*n)) + list(range(3*n,4*n))]
+    labels += [[5*n+k, 2*n+k, k] for k in range(n)]
+    return labels, list(range(4*n,6*n))
+
+@lru_cache(maxsize=None)
+def get_contraction_path(n, DIM):
+    ''' Returns the pairwise contraction sequence used by W_gate for an n-qudit
+        gate as a list of (operand positions, tensordot axes), together with
+        the final axis permutation. The order is found once per (n, DIM) with
+        numpy's greedy path search (an exhaustive search is already
+        intractable for n=3) and then cached.
+        Every label of the network is shared by at most two operands, so each
+        pairwise step is a plain tensordot, which autograd differentiates
+        cheaply.
+    '''
+    labels, out_labels = get_index_network(n)
+    sizes = [DIM]*(4*n) + [DIM*DIM]*(2*n)
+    return get_pairwise_steps(labels, out_labels, sizes)
+
+def get_pairwise_steps(labels, out_labels, sizes):
+    ''' Returns the greedy pairwise contraction sequence of a network in which
+        every label is shared by at most two operands, as a list of (operand
+        positions, tensordot axes), together with the final axis permutation.
+    '''
+    labels = [list(lab) for lab in labels]
+    interleaved = []
+    for lab in labels:
+        interleaved += [onp.empty([sizes[i] for i in lab]), lab]
+    path = onp.einsum_path(*interleaved, out_labels, optimize='greedy')[0][1:]
+
+    steps = []
+    for (i, j) in path:
+        lab_a, lab_b = labels[i], labels[j]
+        shared = [k for k in lab_a if k in lab_b]
+        axes = ([lab_a.index(k) for k in shared],
+                [lab_b.index(k) for k in shared])
+        for p in sorted((i, j), reverse=True):
+            del labels[p]
+        labels.append([k for k in lab_a + lab_b if k not in shared])
+        steps.append(((i, j), axes))
+    perm = [labels[0].index(k) for k in out_labels]
+    return steps, perm
+
+def get_environment(operands, pos, batch=False):
+    ''' Returns the contraction of the weighted network used by dW_gate
+        with the operand at position pos removed, i.e. the derivative of the
+        network with respect to that operand, with the operand's own indices.
+        The operands are U, G_k (k=1..n), U^*, F_k (k=1..n) and the weight
+        tensor T[P_1,...,P_n,R_1,...,R_n]; if batch is True, they all carry
+        a leading batch axis, which is kept.
+        Output - ndarray of the shape of operands[pos]
+    '''
+    n = (len(operands)-3)//2
+    operands = operands[:pos] + operands[pos+1:]
+    steps, perm = get_environment_path(n, operands[0].shape[-1], pos)
+    for (i, j), axes in steps:
+        a, b = operands[i], operands[j]
+        for p in sorted((i, j), reverse=True):
+            del operands[p]
+        if batch:
+            operands.append(batch_tensordot(a, b, axes))
+        else:
+            operands.append(onp.tensordot(a, b, axes))
+    if batch:
+        return onp.transpose(operands[0], [0]+[p+1 for p in perm])
+    return onp.transpose(operands[0], perm)
+
+@lru_cache(maxsize=None)
+def get_environment_path(n, DIM, pos):
+    ''' Returns the pairwise contraction sequence of get_environment, found
+        once per (n, DIM, pos) and then cached. The network is that of
+        get_index_network with the weight tensor T[P_1,...,P_n,R_1,...,R_n]
+        attached to the input and output points.
+    '''
+    labels, out_labels = get_index_network(n)
+    labels = labels + [out_labels]
+    sizes = [DIM]*(4*n) + [DIM*DIM]*(2*n)
+    return get_pairwise_steps(labels[:pos] + labels[pos+1:], labels[pos],
+                              sizes)
@@ -1,64 +1,43 @@
 import os
-from numba import (jit, prange, types)
 import numpy as np
+try:
+    import numba
+    from numba import (jit, prange, types)
+except ImportError:
+    # Without numba the jitted samplers run as (slow) plain Python;
+    # sample_batch and build_alias_tables_batch below are the vectorised
+    # fallbacks.
+    numba = None
+    prange = range
+    def jit(*args, **kwargs):
+        return lambda fun: fun
 import numpy.random as nr
 import time
+from phase_space import(get_arity_groups)
 
 @jit(nopython=True, cache=True) # Comment out this line to ignore numba
-def sample_fast(sample_size, meas_list, index_list,
-          qd_list_states, qd_list_gates, qd_list_meas, pd_list_states,
-          pd_list_gates, pd_list_meas, sign_list_states, sign_list_gates,
-          sign_list_meas, neg_list_states, neg_list_gates, neg_list_meas):
+def sample_fast(sample_size, meas_list, index_flat, index_offsets,
+          stride_flat, qd_list_meas, qd_list_states, neg_list_states,
+          alias_prob_states, alias_idx_states, sign_bits_gates,
+          neg_flat_gates, alias_prob_gates, alias_idx_gates, gate_offsets,
+          neg_offsets, det_flat_gates, rand_index_gates):
     sample_size = np.int64(sample_size)
     N = meas_list.shape[0]
+    rand = np.empty(N + np.sum(rand_index_gates >= 0))
     p_out = 0 # np.zeros(sample_size) #
     for n in prange(sample_size):
         if n%(sample_size//10)==0:
             print("------")
             print((n/sample_size)*100, "%")
 
-        current_ps_point = np.zeros(N, dtype=np.int64)
-        p_estimate = 1.
-
-        # Input states
-        for s in range(N):
-            ps_point = np.arange(len(pd_list_states[s]), dtype=np.int64
-                         )[np.searchsorted(np.cumsum(pd_list_states[s]),
-                                           np.random.random(), side="right")]
-            current_ps_point[s] = ps_point
-            p_estimate *= neg_list_states[s]*sign_list_states[s][ps_point]
-
-        # Gates
-        for g in range(index_list.shape[0]):
-            idx = index_list[g]
-
-            arr_dim = np.log2(len(pd_list_gates[g]))/2
-            pq_in = 0
-            for i in range(len(idx)):
-                pq_in += current_ps_point[idx[i]]//2 * 2**(2*(arr_dim-i)-1)
-                pq_in += current_ps_point[idx[i]]%2 * 2**(2*(arr_dim-i)-2)
-            pq_in = np.int64(pq_in)
-
-            prob = pd_list_gates[g,pq_in:pq_in+np.int64(2**arr_dim)]
-            prob = prob/prob.sum()
-            sign = sign_list_gates[g,pq_in:pq_in+np.int64(2**arr_dim)]
-            neg = neg_list_gates[g,np.int64(pq_in//(2**arr_dim))]
-
-            # The next line is the cause of the segmentation fault.
-            # I suspect it's related to the type/values/normalisation of
-            # array prob.
-            ps_point = np.arange(len(prob), dtype=np.int64)[np.searchsorted(
-              np.cumsum(prob), np.random.random(), side="right")]
-
-            prob_dim = np.log2(len(prob))/2
-            for i in range(len(idx)):
-                current_ps_point[idx[i]] = int(ps_point/4**(prob_dim-1-i))%4
-            p_estimate *= neg*sign[ps_point]
-
-
-        # Measurement
-        for m in range(N):
-            p_estimate *= qd_list_meas[m,current_ps_point[m]]
+        for r in range(rand.shape[0]):
+            rand[r] = np.random.random()
+        p_estimate = sample_trajectory(rand, index_flat, index_offsets,
+                       stride_flat, qd_list_meas, qd_list_states,
+                       neg_list_states, alias_prob_states, alias_idx_states,
+                       sign_bits_gates, neg_flat_gates, alias_prob_gates,
+                       alias_idx_gates, gate_offsets, neg_offsets,
+                       det_flat_gates, rand_index_gates)
         p_out += 1./sample_size * p_estimate
         # p_out[n] = p_estimate
 
@@ -74,136 +53,557 @@ def sample_fast(sample_size, meas_list, index_list,
     # p_out = (1./sample_size) * np.cumsum(p_out)
     return p_out
 
+def sample_parallel(sample_size, meas_list, index_flat, index_offsets,
+          stride_flat, qd_list_meas, qd_list_states, neg_list_states,
+          alias_prob_states, alias_idx_states, sign_bits_gates,
+          neg_flat_gates, alias_prob_gates, alias_idx_gates, gate_offsets,
+          neg_offsets, det_flat_gates, rand_index_gates, seed=None,
+          n_workers=None):
+    '''
+    Multi-core version of sample_fast. The samples are split between
+    n_workers workers (default: number of numba threads), each drawing from
+    its own RNG stream spawned from the master seed and keeping its own
+    partial sum. For fixed (seed, n_workers) the estimate is reproducible
+    regardless of how many threads actually run.
+    '''
+    if n_workers is None:
+        n_workers = numba.get_num_threads() if numba is not None else 1
+    seeds = nr.SeedSequence(seed).generate_state(n_workers, dtype=np.uint64)
+    p_partial, _ = sample_workers(sample_size, seeds, meas_list, index_flat,
+                     index_offsets, stride_flat, qd_list_meas,
+                     qd_list_states, neg_list_states, alias_prob_states,
+                     alias_idx_states, sign_bits_gates, neg_flat_gates,
+                     alias_prob_gates, alias_idx_gates, gate_offsets,
+                     neg_offsets, det_flat_gates, rand_index_gates)
+    return p_partial.sum()/sample_size
+
+@jit(nopython=True, parallel=True, cache=True)
+def sample_workers(sample_size, seeds, meas_list, index_flat, index_offsets,
+                   stride_flat, qd_list_meas, qd_list_states,
+                   neg_list_states, alias_prob_states, alias_idx_states,
+                   sign_bits_gates, neg_flat_gates, alias_prob_gates,
+                   alias_idx_gates, gate_offsets, neg_offsets,
+                   det_flat_gates, rand_index_gates):
+    sample_size = np.int64(sample_size)
+    n_workers = seeds.shape[0]
+    N = meas_list.shape[0]
+    p_partial = np.zeros(n_workers)
+    p2_partial = np.zeros(n_workers)
+    for w in prange(n_workers):
+        rng_state = np.array([seeds[w]])
+        rand = np.empty(N + np.sum(rand_index_gates >= 0))
+        worker_size = sample_size//n_workers
+        if w < sample_size%n_workers:
+            worker_size += 1
+
+        p_worker, p2_worker = 0., 0.
+        for n in range(worker_size):
+            for r in range(rand.shape[0]):
+                rand[r] = splitmix64(rng_state)
+            p_estimate = sample_trajectory(rand, index_flat, index_offsets,
+                           stride_flat, qd_list_meas, qd_list_states,
+                           neg_list_states, alias_prob_states,
+                           alias_idx_states, sign_bits_gates, neg_flat_gates,
+                           alias_prob_gates, alias_idx_gates, gate_offsets,
+                           neg_offsets, det_flat_gates, rand_index_gates)
+            p_worker += p_estimate
+            p2_worker += p_estimate*p_estimate
+        p_partial[w] = p_worker
+        p2_partial[w] = p2_worker
+    return p_partial, p2_partial
+
+def sample_batch(sample_size, meas_list, index_flat, index_offsets,
+          stride_flat, qd_list_meas, qd_list_states, neg_list_states,
+          alias_prob_states, alias_idx_states, sign_bits_gates,
+          neg_flat_gates, alias_prob_gates, alias_idx_gates, gate_offsets,
+          neg_offsets, det_flat_gates, rand_index_gates, batch_size=2**14,
+          seed=None):
+    '''
+    Vectorised version of sample_fast in plain numpy. Blocks of batch_size
+    trajectories are advanced through the circuit together: a (batch_size, N)
+    array holds the current phase space points and each state/gate draws
+    the whole block from its alias tables in one step.
+    '''
+    rng = nr.default_rng(seed)
+    sample_size = int(sample_size)
+
+    p_out = 0.
+    for b0 in range(0, sample_size, batch_size):
+        p_out += sample_block(min(batch_size, sample_size-b0), rng,
+                   index_flat, index_offsets, stride_flat, qd_list_meas,
+                   qd_list_states, neg_list_states, alias_prob_states,
+                   alias_idx_states, sign_bits_gates, neg_flat_gates,
+                   alias_prob_gates, alias_idx_gates, gate_offsets,
+                   neg_offsets, det_flat_gates, rand_index_gates).sum()
+    return p_out/sample_size
+
+def sample_block(B, rng, index_flat, index_offsets, stride_flat,
+                 qd_list_meas, qd_list_states, neg_list_states,
+                 alias_prob_states, alias_idx_states, sign_bits_gates,
+                 neg_flat_gates, alias_prob_gates, alias_idx_gates,
+                 gate_offsets, neg_offsets, det_flat_gates,
+                 rand_index_gates):
+    '''
+    Samples B trajectories together and returns their B estimates.
+    '''
+    N = qd_list_meas.shape[0]
+    K = alias_prob_states.shape[1]
+    current_ps_point = np.empty((B, N), dtype=np.int64)
+    p_estimate = np.ones(B)
+
+    # Input states
+    for s in range(N):
+        ps_point = sample_alias_batch(alias_prob_states[s],
+                     alias_idx_states[s], 0, K, rng.random(B))
+        current_ps_point[:,s] = ps_point
+        p_estimate *= neg_list_states[s]*np.sign(
+                          qd_list_states[s,ps_point])
+
+    # Gates
+    for g in range(index_offsets.shape[0]-1):
+        idx = index_flat[index_offsets[g]:index_offsets[g+1]]
+        strides = stride_flat[index_offsets[g]:index_offsets[g+1]]
+        row_len = K*strides[0]
+
+        row = current_ps_point[:,idx].dot(strides)
+        pq_in = gate_offsets[g] + row*row_len
+        det_point = det_flat_gates[neg_offsets[g]+row]
+        if rand_index_gates[g] < 0:
+            ps_point = det_point
+        else:
+            ps_point = np.where(det_point >= 0, det_point,
+                                sample_alias_batch(alias_prob_gates,
+                                  alias_idx_gates, pq_in, row_len,
+                                  rng.random(B)))
+        current_ps_point[:,idx] = (ps_point[:,None]//strides)%K
+        pos = pq_in+ps_point
+        sign = 1 - 2*((sign_bits_gates[pos >> 3] >> (7 - (pos & 7))) & 1)
+        p_estimate *= neg_flat_gates[neg_offsets[g]+row]*sign
+
+    # Measurement
+    for m in range(N):
+        p_estimate *= qd_list_meas[m,current_ps_point[:,m]]
+    return p_estimate
+
+def sample_streaming(sample_size, meas_list, index_flat, index_offsets,
+          stride_flat, qd_list_meas, qd_list_states, neg_list_states,
+          alias_prob_states, alias_idx_states, sign_bits_gates,
+          neg_flat_gates, alias_prob_gates, alias_idx_gates, gate_offsets,
+          neg_offsets, det_flat_gates, rand_index_gates, checkpoint=10**5,
+          eps=None, delta=0.05,
+          bound='bernstein', engine='parallel', seed=None, n_workers=None,
+          batch_size=2**14, show_log=False):
+    '''
+    Estimates the Born probability in chunks of checkpoint samples, using
+    the 'parallel' (sample_workers) or 'batch' (sample_block) engine. After
+    every chunk the running mean, sample variance and the half-width of a
+    confidence interval are recorded; sampling stops early once the
+    half-width drops below eps (if given) or sample_size is reached.
+    The interval at the k-th checkpoint is a two-sided (1-delta_k) interval
+    with delta_k = 6 delta/(pi^2 k^2). As sum_k delta_k = delta, the
+    intervals of all checkpoints hold simultaneously with probability at
+    least 1-delta, so the interval reported at the (data-dependent)
+    stopping point covers the Born probability with probability at least
+    1-delta.
+        bound - 'hoeffding' or 'bernstein' (empirical Bernstein, Maurer &
+                Pontil), both using the a priori bound on |p_estimate|
+                given by get_estimate_bound.
+    Output - (p_out, stats) with stats = {'sample_size', 'mean', 'var',
+             'half_width'} arrays over checkpoints
+    '''
+    sample_size = int(sample_size)
+    if sample_size < 1:
+        raise Exception('sample_size must be at least 1')
+    if n_workers is None:
+        n_workers = numba.get_num_threads() if numba is not None else 1
+    seed_seq = nr.SeedSequence(seed)
+    rng = nr.default_rng(seed_seq.spawn(1)[0])
+    p_max = get_estimate_bound(qd_list_meas, neg_list_states, neg_flat_gates,
+                               neg_offsets)
+
+    n, p_sum, p2_sum = 0, 0., 0.
+    stats = {'sample_size': [], 'mean': [], 'var': [], 'half_width': []}
+    while n < sample_size:
+        chunk = min(checkpoint, sample_size-n)
+        if engine=='parallel':
+            seeds = seed_seq.spawn(1)[0].generate_state(n_workers,
+                                                        dtype=np.uint64)
+            p_partial, p2_partial = sample_workers(chunk, seeds, meas_list,
+              index_flat, index_offsets, stride_flat, qd_list_meas,
+              qd_list_states, neg_list_states, alias_prob_states,
+              alias_idx_states, sign_bits_gates, neg_flat_gates,
+              alias_prob_gates, alias_idx_gates, gate_offsets, neg_offsets,
+              det_flat_gates, rand_index_gates)
+            p_sum += p_partial.sum()
+            p2_sum += p2_partial.sum()
+        elif engine=='batch':
+            for b0 in range(0, chunk, batch_size):
+                p_estimate = sample_block(min(batch_size, chunk-b0), rng,
+                  index_flat, index_offsets, stride_flat, qd_list_meas,
+                  qd_list_states, neg_list_states, alias_prob_states,
+                  alias_idx_states, sign_bits_gates, neg_flat_gates,
+                  alias_prob_gates, alias_idx_gates, gate_offsets,
+                  neg_offsets, det_flat_gates, rand_index_gates)
+                p_sum += p_estimate.sum()
+                p2_sum += (p_estimate*p_estimate).sum()
+        else:
+            raise Exception('Invalid engine')
+        n += chunk
+
+        mean = p_sum/n
+        var = max(p2_sum - n*mean*mean, 0.)/max(n-1, 1)
+        k = len(stats['sample_size']) + 1
+        half_width = get_half_width(n, var, p_max, 6.*delta/(np.pi*k)**2,
+                                    bound)
+        stats['sample_size'].append(n)
+        stats['mean'].append(mean)
+        stats['var'].append(var)
+        stats['half_width'].append(half_width)
+        if show_log==True:
+            print('%d samples: %.6f +- %.6f'%(n, mean, half_width))
+        if eps is not None and half_width <= eps:
+            break
+
+    stats = {key: np.array(val) for key, val in stats.items()}
+    return mean, stats
+
+def get_estimate_bound(qd_list_meas, neg_list_states, neg_flat_gates,
+                       neg_offsets):
+    '''
+    Returns the a priori bound on the magnitude of a single trajectory
+    estimate, i.e. the product of the largest negativities of every element.
+    '''
+    neg_max_gates = [neg_flat_gates[neg_offsets[g]:neg_offsets[g+1]].max()
+                     for g in range(len(neg_offsets)-1)]
+    return (np.prod(neg_list_states)*np.prod(neg_max_gates)*
+            np.prod(np.abs(qd_list_meas).max(axis=1)))
+
+def get_half_width(n, var, p_max, delta, bound='bernstein'):
+    '''
+    Returns the half-width of a two-sided (1-delta) confidence interval for
+    the mean of n i.i.d. estimates in [-p_max, p_max] with sample variance
+    var. The empirical Bernstein bound (Maurer & Pontil, Thm 4) is
+    one-sided at confidence 1-delta with log(2/delta); applying it to both
+    tails at delta/2 each gives log(4/delta).
+    '''
+    if bound=='hoeffding':
+        return p_max*np.sqrt(2.*np.log(2./delta)/n)
+    elif bound=='bernstein':
+        if n < 2:
+            return np.inf
+        log_term = np.log(4./delta)
+        return np.sqrt(2.*var*log_term/n) + 14.*p_max*log_term/(3.*(n-1))
+    else:
+        raise Exception('Invalid bound')
+
+def sample_alias_batch(alias_prob, alias_idx, start, length, r):
+    '''
+    Vectorised sample_alias: draws one index per entry of the uniform random
+    array r, start may be a scalar or an array of the same shape as r.
+    '''
+    i = np.minimum((r*length).astype(np.int64), length-1)
+    accept = r*length - i < alias_prob[start+i]
+    return np.where(accept, i, alias_idx[start+i])
+
+@jit(nopython=True, cache=True)
+def splitmix64(rng_state):
+    '''
+    Advances the splitmix64 generator state (uint64 array of length 1) and
+    returns a uniform random number in [0,1).
+    '''
+    rng_state[0] += np.uint64(0x9E3779B97F4A7C15)
+    z = rng_state[0]
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    z = z ^ (z >> np.uint64(31))
+    return (z >> np.uint64(11)) * (1./9007199254740992.)
+
+@jit(nopython=True, cache=True)
+def sample_trajectory(rand, index_flat, index_offsets, stride_flat,
+                      qd_list_meas, qd_list_states, neg_list_states,
+                      alias_prob_states, alias_idx_states, sign_bits_gates,
+                      neg_flat_gates, alias_prob_gates, alias_idx_gates,
+                      gate_offsets, neg_offsets, det_flat_gates,
+                      rand_index_gates):
+    '''
+    Samples one phase space trajectory through the circuit and returns its
+    estimate of the Born probability. rand holds the uniform random numbers
+    used for the N state draws followed by one draw per gate with random
+    rows (rand_index_gates); deterministic rows take their single output
+    from det_flat_gates without a draw.
+    '''
+    N = qd_list_meas.shape[0]
+    current_ps_point = np.zeros(N, dtype=np.int64)
+    p_estimate = 1.
+
+    # Input states
+    for s in range(N):
+        ps_point = sample_alias(alias_prob_states[s], alias_idx_states[s],
+                                0, alias_prob_states.shape[1], rand[s])
+        current_ps_point[s] = ps_point
+        p_estimate *= neg_list_states[s]*np.sign(qd_list_states[s,ps_point])
+
+    # Gates
+    K = alias_prob_states.shape[1]
+    for g in range(index_offsets.shape[0]-1):
+        i0, i1 = index_offsets[g], index_offsets[g+1]
+        row_len = K*stride_flat[i0]
+
+        row = 0
+        for i in range(i0, i1):
+            row += current_ps_point[index_flat[i]]*stride_flat[i]
+        pq_in = gate_offsets[g] + row*row_len
+
+        ps_point = det_flat_gates[neg_offsets[g]+row]
+        if ps_point < 0:
+            ps_point = sample_alias(alias_prob_gates, alias_idx_gates, pq_in,
+                                    row_len, rand[rand_index_gates[g]])
+        for i in range(i0, i1):
+            current_ps_point[index_flat[i]] = (ps_point//stride_flat[i])%K
+        p_estimate *= (neg_flat_gates[neg_offsets[g]+row]*
+                       get_sign(sign_bits_gates, pq_in+ps_point))
+
+    # Measurement
+    for m in range(N):
+        p_estimate *= qd_list_meas[m,current_ps_point[m]]
+    return p_estimate
+
+@jit(nopython=True, cache=True)
+def get_sign(sign_bits, pos):
+    '''
+    Returns the sign (+1/-1) stored at bit pos of the packed array sign_bits
+    (np.packbits order, bit set for negative entries).
+    '''
+    return 1 - 2*((sign_bits[pos >> 3] >> (7 - (pos & 7))) & 1)
+
+@jit(nopython=True, cache=True)
+def sample_alias(alias_prob, alias_idx, start, length, r):
+    '''
+    Draws an index in [0,length) from the alias table stored in
+    alias_prob[start:start+length], alias_idx[start:start+length], using a
+    single uniform random number r.
+    '''
+    u = r*length
+    i = np.int64(u)
+    if i >= length:
+        i = length-1
+    if u - i < alias_prob[start+i]:
+        return i
+    return alias_idx[start+i]
+
+@jit(nopython=True, cache=True)
+def build_alias_tables(prob_rows):
+    '''
+    Builds Walker/Vose alias tables for each row of the 2d array prob_rows
+    (rows need not be normalised).
+    Output - (acceptance probabilities, alias indices), both of the shape of
+             prob_rows
+    '''
+    n_rows, K = prob_rows.shape
+    alias_prob = np.ones((n_rows, K))
+    alias_idx = np.zeros((n_rows, K), dtype=np.int64)
+    small = np.empty(K, dtype=np.int64)
+    large = np.empty(K, dtype=np.int64)
+    for r in range(n_rows):
+        scaled = prob_rows[r]*K/prob_rows[r].sum()
+        n_small, n_large = 0, 0
+        for i in range(K):
+            alias_idx[r,i] = i
+            if scaled[i] < 1.:
+                small[n_small] = i
+                n_small += 1
+            else:
+                large[n_large] = i
+                n_large += 1
+        while n_small > 0 and n_large > 0:
+            n_small -= 1
+            n_large -= 1
+            i_small, i_large = small[n_small], large[n_large]
+            alias_prob[r,i_small] = scaled[i_small]
+            alias_idx[r,i_small] = i_large
+            scaled[i_large] += scaled[i_small] - 1.
+            if scaled[i_large] < 1.:
+                small[n_small] = i_large
+                n_small += 1
+            else:
+                large[n_large] = i_large
+                n_large += 1
+    return alias_prob, alias_idx
+
+def build_alias_tables_batch(prob_rows):
+    '''
+    Plain numpy version of build_alias_tables, used when numba is not
+    available. The Vose pairing is taken in closed form: the small entries
+    (scaled probability < 1) of a row are filled in index order by its
+    large entries in index order, each large one filling small entries
+    while it is >= 1 and then becoming small itself, filled by the next
+    large one. Small entry t then takes the first large entry k whose
+    cumulative excess reaches the cumulative deficit before t, which is a
+    searchsorted per row. The tables differ from those of
+    build_alias_tables but give the same distributions.
+    '''
+    n_rows, K = prob_rows.shape
+    scaled = prob_rows*K/prob_rows.sum(axis=1, keepdims=True)
+    alias_prob = np.ones((n_rows, K))
+    alias_idx = np.tile(np.arange(K, dtype=np.int64), (n_rows, 1))
+
+    # Entries of each row reordered as small ones, then large ones
+    is_small = scaled < 1.
+    order = np.argsort(~is_small, axis=1, kind='stable')
+    scaled = np.take_along_axis(scaled, order, axis=1)
+    n_small = is_small.sum(axis=1)
+    small_pos = np.arange(K) < n_small[:,None]
+    deficit = np.where(small_pos, 1.-scaled, 0.)
+    cum_deficit = np.cumsum(deficit, axis=1)
+    cum_excess = np.cumsum(np.where(small_pos, 0., scaled-1.), axis=1)
+
+    for r in range(n_rows):
+        S = n_small[r]
+        if S == 0 or S == K:
+            continue
+        small, large = order[r,:S], order[r,S:]
+        excess = cum_excess[r,S:]
+        k = np.minimum(np.searchsorted(excess, cum_deficit[r,:S]
+                                       - deficit[r,:S]), K-S-1)
+        alias_prob[r,small] = scaled[r,:S]
+        alias_idx[r,small] = large[k]
+        # Every large entry but the last ends below 1 after filling its
+        # small entries and is filled by the next one
+        n_filled = np.searchsorted(k, np.arange(K-S-1), side='right')
+        remaining = 1. + excess[:-1] - np.append(0., cum_deficit[r,:S])[
+                                           n_filled]
+        alias_prob[r,large[:-1]] = np.clip(remaining, 0., 1.)
+        alias_idx[r,large[:-1]] = large[1:]
+    return alias_prob, alias_idx
+
 def get_qd_output(circuit, par_list, ps):
     '''
     Calculate the quasi-probability distribution of each circuit element
-    and return them as a list of [state qds, gate qds, measurement qds].
+    and return them as a list of [state qds, gate qds, measurement qds],
+    together with their negativities (per input row for gates). Normalised
+    distributions and signs are not stored; both follow from the signed qds.
     '''
     par_idx_states = np.arange(0, len(circuit["state_list"]))
-    par_idx_gates = par_list[1]
-    par_idx_meas = par_list[2]
-    par_vals = par_list[0]
+    par_idx_gates = par_list['x_index_gate']
+    par_idx_meas = par_list['x_index_meas']
+    par_vals = par_list['x_list']
 
     qd_list_states = []   # qd lists
-    qd_list_gates = []
     qd_list_meas = []
 
     neg_list_states = []  # qd negativity lists
-    neg_list_gates = []
     neg_list_meas = []
 
-    sign_list_states = [] # sign of qd lists
-    sign_list_gates = []
-    sign_list_meas = []
-
-    pd_list_states = []   # normalised prob dist lists
-    pd_list_gates = []
-    pd_list_meas = []
-
     # States
     for s, state in enumerate(circuit['state_list']):
         x = par_vals[par_idx_states[s]]
 
         qd_state = ps.W_state(state, x)
-        pd_state = np.abs(qd_state)
-        neg_state = pd_state.sum()
-        pd_state /= neg_state
-        sign_state = np.sign(qd_state)
-
         qd_list_states.append(qd_state)
-        pd_list_states.append(pd_state)
-        neg_list_states.append(neg_state)
-        sign_list_states.append(sign_state)
+        neg_list_states.append(np.abs(qd_state).sum())
 
-    # Gates
-    for g, gate in enumerate(circuit['gate_list']):
-        idx = circuit['index_list'][g]
-
-        x_in, x_out = [], []
-        for k in par_idx_gates[g][0]:
-            x_in.append(par_vals[k])
-        for k in par_idx_gates[g][1]:
-            x_out.append(par_vals[k])
-
-        qd_gate = ps.W_gate(gate, x_in, x_out)
-        pd_gate = np.abs(qd_gate)
-        neg_gate = pd_gate.sum(axis=tuple(range(2*len(idx),4*len(idx))))
-        for i in range(2*len(idx)):
-            pd_gate = pd_gate.swapaxes(i,2*len(idx)+i)
-        pd_gate = pd_gate/neg_gate
-        for i in range(2*len(idx)):
-            pd_gate = pd_gate.swapaxes(i,2*len(idx)+i)
-        sign_gate = np.sign(qd_gate)
-
-        qd_list_gates.append(qd_gate)
-        pd_list_gates.append(pd_gate)
-        neg_list_gates.append(neg_gate)
-        sign_list_gates.append(sign_gate)
+    # Gates (evaluated in batches of equal arity)
+    L = len(circuit['gate_list'])
+    qd_list_gates, neg_list_gates = [None]*L, [None]*L
+
+    for n, group in get_arity_groups(circuit['index_list']).items():
+        gates = np.stack([circuit['gate_list'][g] for g in group])
+        x_in = [[par_vals[k] for k in par_idx_gates[g][0]] for g in group]
+        x_out = [[par_vals[k] for k in par_idx_gates[g][1]] for g in group]
+
+        qd_gates = ps.W_gate_batch(gates, x_in, x_out)
+        neg_gates = np.abs(qd_gates).sum(axis=tuple(range(2*n+1,4*n+1)))
+        for i, g in enumerate(group):
+            qd_list_gates[g] = qd_gates[i]
+            neg_list_gates[g] = neg_gates[i]
 
     # Measurements
     for m, meas in enumerate(circuit['meas_list']):
         x = par_vals[par_idx_meas[m]]
 
         qd_meas = ps.W_meas(meas, x)
-        pd_meas = np.abs(qd_meas)
-        neg_meas = np.max(pd_meas)
-        sign_meas = np.sign(qd_meas)
-
         qd_list_meas.append(qd_meas)
-        pd_list_meas.append(pd_meas)
-        neg_list_meas.append(neg_meas)
-        sign_list_meas.append(sign_meas)
+        neg_list_meas.append(np.abs(qd_meas).max())
 
     output = {
     'qd_list_states': qd_list_states, 'qd_list_gates': qd_list_gates,
-    'qd_list_meas': qd_list_meas, 'pd_list_states': pd_list_states,
-    'pd_list_gates': pd_list_gates, 'pd_list_meas': pd_list_meas,
-    'neg_list_states': neg_list_states, 'neg_list_gates': neg_list_gates,
-    'neg_list_meas': neg_list_meas, 'sign_list_states': sign_list_states,
-    'sign_list_gates': sign_list_gates, 'sign_list_meas': sign_list_meas
+    'qd_list_meas': qd_list_meas, 'neg_list_states': neg_list_states,
+    'neg_list_gates': neg_list_gates, 'neg_list_meas': neg_list_meas
     }
     return output
 
-def prepare_sampler(circuit, par_list, ps):
+def prepare_sampler(circuit, par_list, ps, det_tol=1e-12):
+    '''
+    Returns the tables used by the samplers. Gates of any (mixed) arity are
+    packed CSR-style: the tables of gate g occupy
+    [gate_offsets[g], gate_offsets[g+1]) of one flat buffer, its per-row
+    negativities [neg_offsets[g], neg_offsets[g+1]) and its wires and
+    strides [index_offsets[g], index_offsets[g+1]).
+    Only the alias tables (built once from |qd|), the per-row negativities
+    and the gate signs, packed to one bit per entry (1 for negative), are
+    kept for gates; state signs are read off the signed qds directly.
+    Rows with a single non-zero entry (up to det_tol relative to the row
+    negativity), e.g. Clifford gates in the Pauli frame at x0, are
+    deterministic: det_flat_gates holds their output point (-1 for random
+    rows), and gates without random rows take no random number
+    (rand_index_gates[g] = -1, otherwise the position of the gate's draw).
+    '''
     meas_list = np.stack(circuit["meas_list"]).astype(np.float64)
-    index_list = np.array(circuit["index_list"]).astype(np.int64)
+    index_list = circuit["index_list"]
 
     output = get_qd_output(circuit, par_list, ps)
 
-    qd_list_states = np.stack([dist.flatten().astype(np.float64)
-                               for dist in output["qd_list_states"]])
-    qd_list_gates = np.stack([dist.flatten().astype(np.float64)
-                              for dist in output["qd_list_gates"]])
+    # States and measurements
     qd_list_meas = np.stack([dist.flatten().astype(np.float64)
                              for dist in output["qd_list_meas"]])
-
+    qd_list_states = np.stack([dist.flatten().astype(np.float64)
+                               for dist in output["qd_list_states"]])
     neg_list_states = np.array(output["neg_list_states"]).astype(np.float64)
-    neg_list_gates = np.stack([dist.flatten().astype(np.float64)
-                               for dist in output["neg_list_gates"]])
-    neg_list_meas = np.array(output["neg_list_meas"]).astype(np.float64)
-
-    pd_list_states = np.stack([dist.flatten().astype(np.float64)
-                               for dist in output["pd_list_states"]])
-    pd_list_gates = np.stack([dist.flatten().astype(np.float64)
-                              for dist in output["pd_list_gates"]])
-    pd_list_meas = np.stack([dist.flatten().astype(np.float64)
-                             for dist in output["pd_list_meas"]])
-
-    sign_list_states = np.stack([dist.flatten().astype(np.float64)
-                                 for dist in output["sign_list_states"]])
-    sign_list_gates = np.stack([dist.flatten().astype(np.float64)
-                                for dist in output["sign_list_gates"]])
-    sign_list_meas = np.stack([dist.flatten().astype(np.float64)
-                               for dist in output["sign_list_meas"]])
-
-    return(meas_list, index_list, qd_list_states, qd_list_gates, qd_list_meas,
-           pd_list_states, pd_list_gates, pd_list_meas, sign_list_states,
-           sign_list_gates, sign_list_meas, neg_list_states, neg_list_gates,
-           neg_list_meas)
-
-
-
-
-
-
+    # The jitted builder runs as a Python loop without numba
+    build_tables = (build_alias_tables if numba is not None
+                    else build_alias_tables_batch)
+    alias_prob_states, alias_idx_states = build_tables(
+        np.abs(qd_list_states))
+    alias_idx_states = alias_idx_states.astype(np.int32)
+    K = alias_prob_states.shape[1]
 
+    # Gates
+    index_offsets = np.cumsum([0]+[len(idx) for idx in index_list])
+    index_flat = np.concatenate(index_list).astype(np.int64)
+    stride_flat = np.concatenate([K**np.arange(len(idx)-1, -1, -1)
+                                  for idx in index_list]).astype(np.int64)
+
+    gate_offsets = np.cumsum([0]+[dist.size
+                                  for dist in output["qd_list_gates"]])
+    neg_offsets = np.cumsum([0]+[neg.size
+                                 for neg in output["neg_list_gates"]])
+    neg_flat_gates = np.concatenate([neg.flatten().astype(np.float64)
+                                     for neg in output["neg_list_gates"]])
+    sign_bits_gates = np.packbits(np.concatenate(
+        [dist.flatten() < 0 for dist in output["qd_list_gates"]]))
+
+    alias_prob_gates, alias_idx_gates = [], []
+    for dist, neg in zip(output["qd_list_gates"], output["neg_list_gates"]):
+        alias_prob, alias_idx = build_tables(
+            np.abs(dist).reshape(neg.size, -1).astype(np.float64))
+        alias_prob_gates.append(alias_prob.flatten())
+        alias_idx_gates.append(alias_idx.flatten().astype(np.int32))
+    alias_prob_gates = np.concatenate(alias_prob_gates)
+    alias_idx_gates = np.concatenate(alias_idx_gates)
+
+    det_flat_gates, rand_index_gates = [], []
+    n_rand = len(circuit["state_list"])
+    for dist, neg in zip(output["qd_list_gates"], output["neg_list_gates"]):
+        dist_abs = np.abs(dist).reshape(neg.size, -1)
+        is_det = (dist_abs > det_tol*neg.reshape(-1,1)).sum(axis=1)==1
+        det_flat_gates.append(np.where(is_det, dist_abs.argmax(axis=1), -1))
+        rand_index_gates.append(-1 if is_det.all() else n_rand)
+        n_rand += 0 if is_det.all() else 1
+    det_flat_gates = np.concatenate(det_flat_gates).astype(np.int64)
+    rand_index_gates = np.array(rand_index_gates, dtype=np.int64)
+
+    return(meas_list, index_flat, index_offsets.astype(np.int64), stride_flat,
+           qd_list_meas, qd_list_states, neg_list_states, alias_prob_states,
+           alias_idx_states, sign_bits_gates, neg_flat_gates,
+           alias_prob_gates, alias_idx_gates, gate_offsets.astype(np.int64),
+           neg_offsets.astype(np.int64), det_flat_gates, rand_index_gates)
@@ -2,12 +2,7 @@ import numpy as np
 import numpy.random as nr
 from numpy.linalg import qr
 from qubit_circuit_components import(makeState, makeGate, makeMeas)
-from qubit_state_functions import psi2rho
-
-from qiskit import QuantumCircuit
-from qiskit.quantum_info.operators import Operator
-from qiskit.quantum_info import Statevector
-from functools import reduce
+from qubit_state_functions import rho2psi
 
 def haar_random_connected_circuit(N, L, n, d=2,
                                   given_state=None, given_meas=1, method='c'):
@@ -173,28 +168,31 @@ def show_connectivity(circuit):
         print(wire)
     # return circ_repr
 
-def qiskit_simulate(circuit):
+def statevector_simulate(circuit):
+    ''' Returns the exact Born probability tr[M U rho U^dagger] of the
+        circuit for pure product input states and product measurement
+        effects. The statevector is kept as a (d,)*N tensor: each gate is
+        contracted onto its index_list wires and each measurement effect
+        onto its own wire, so no 2^N x 2^N (or larger) object is formed.
+        Wire k is qudit k of the circuit, and the first tensor factor of a
+        gate acts on the first wire of its index.
+    '''
     N = len(circuit["state_list"])
-    qsk_circ = QuantumCircuit(N)
+    d = len(circuit["state_list"][0])
 
-    qubit_n = 0
+    psi = np.ones(1)
     for state in circuit["state_list"]:
-        if np.allclose(state, makeState('0')): continue
-        elif np.allclose(state, makeState('1')): qsk_circ.x(qubit_n)
-        else: raise Exception('Initial states must be 0 and 1')
-        qubit_n += 1
-    state = Statevector.from_int(0, 2**N)
-
-    gate_n = 0
-    for gate in circuit["gate_list"]:
-        qsk_gate = Operator(gate)
-        qsk_circ.append(qsk_gate, circuit["index_list"][gate_n])
-        gate_n += 1
-
-    meas_effect = reduce(np.kron, circuit["meas_list"])
-
-    state = state.evolve(qsk_circ)
-    final_state = np.array(state.data)
-    p_exact = np.einsum('ij,ji->', psi2rho(final_state), meas_effect)
-    return np.real(p_exact)
-
+        psi = np.kron(psi, rho2psi(state))
+    psi = np.reshape(psi, (d,)*N)
+
+    for gate, index in zip(circuit["gate_list"], circuit["index_list"]):
+        k = len(index)
+        psi = np.tensordot(np.reshape(gate, (d,)*(2*k)), psi,
+                           axes=(list(range(k,2*k)), list(index)))
+        psi = np.moveaxis(psi, list(range(k)), list(index))
+
+    meas_psi = psi
+    for wire, meas in enumerate(circuit["meas_list"]):
+        meas_psi = np.moveaxis(np.tensordot(meas, meas_psi, axes=(1,wire)),
+                               0, wire)
+    return np.real(np.vdot(psi, meas_psi))
@@ -1,5 +1,6 @@
 import autograd.numpy as np
 import itertools as it
+from frame_cache import(frame_cache)
 
 sigma_I = np.array([[1,0],[0,1]],dtype='complex')
 sigma_x = np.array([[0,1],[1,0]],dtype='complex')
@@ -10,6 +11,7 @@ Pauli_list = [np.eye(2),sigma_x,sigma_y,sigma_z]
 x0 = [0,0,0]
 DIM = 2
 
+@frame_cache
 def F(x):
     [a,b,c] = x
     expa = np.exp(1.j*a)
@@ -28,6 +30,7 @@ def F(x):
     return np.array([[P0,P1],[P3,P2]])
 #     return np.array([[sigma_I, sigma_x], [sigma_y, sigma_z]])
 
+@frame_cache
 def G(x):
     [a,b,c] = x
     expa = np.exp(1.j*a)
@@ -45,3 +48,86 @@ def G(x):
                    [expa*(sb*cc-1.j*sc),-cb*cc]])
     return np.array([[P0,P1],[P3,P2]])
 
+def dF(x):
+    return dG(x)/DIM
+
+def dG(x):
+    ''' Returns the derivatives of G(x) with respect to each parameter in
+        x = [a,b,c].
+        Output - (3,DIM,DIM,DIM,DIM) complex ndarray
+    '''
+    [a,b,c] = x
+    expa = np.exp(1.j*a)
+    expac = np.exp(-1.j*a)
+    cb = np.cos(b)
+    sb = np.sin(b)
+    cc = np.cos(c)
+    sc = np.sin(c)
+    zero = np.zeros((2,2))
+
+    P1 = np.array([[-sb, expac*cb],[expa*cb,sb]])
+    P2 = np.array([[cb*sc, expac*(sb*sc-1.j*cc)],
+                   [expa*(sb*sc+1.j*cc),-cb*sc]])
+    P3 = np.array([[cb*cc, expac*(sb*cc+1.j*sc)],
+                   [expa*(sb*cc-1.j*sc),-cb*cc]])
+    # d/da multiplies the upper (lower) off-diagonal entries by -i (+i)
+    phase = np.array([[0,-1.j],[1.j,0]])
+    dP1_da, dP2_da, dP3_da = phase*P1, phase*P2, phase*P3
+
+    dP1_db = np.array([[-cb, -expac*sb],[-expa*sb,cb]])
+    dP2_db = np.array([[-sb*sc, expac*cb*sc],[expa*cb*sc,sb*sc]])
+    dP3_db = np.array([[-sb*cc, expac*cb*cc],[expa*cb*cc,sb*cc]])
+
+    dP1_dc, dP2_dc, dP3_dc = zero, P3, -P2
+
+    return np.array([[[zero,dP1_da],[dP3_da,dP2_da]],
+                     [[zero,dP1_db],[dP3_db,dP2_db]],
+                     [[zero,dP1_dc],[dP3_dc,dP2_dc]]])
+
+def F_bloch(x):
+    return G_bloch(x)/DIM
+
+def G_bloch(x):
+    ''' Returns the coefficients of G(x) in the Pauli basis,
+        G_{ij} = sum_mu g_{ij,mu} sigma_mu with sigma_0 = 1, in closed form.
+        x may carry leading batch axes.
+        Output - x.shape[:-1]+(DIM,DIM,4) real ndarray
+    '''
+    a, b, c = x[...,0], x[...,1], x[...,2]
+    ca, sa = np.cos(a), np.sin(a)
+    cb, sb = np.cos(b), np.sin(b)
+    cc, sc = np.cos(c), np.sin(c)
+    one, zero = np.ones(np.shape(a)), np.zeros(np.shape(a))
+
+    n0 = [one, zero, zero, zero]
+    n1 = [zero, cb*ca, cb*sa, -sb]
+    n2 = [zero, sb*sc*ca-cc*sa, sb*sc*sa+cc*ca, cb*sc]
+    n3 = [zero, sb*cc*ca+sc*sa, sb*cc*sa-sc*ca, cb*cc]
+    return np.moveaxis(np.array([[n0,n1],[n3,n2]]), [0,1,2], [-3,-2,-1])
+
+def dF_bloch(x):
+    return dG_bloch(x)/DIM
+
+def dG_bloch(x):
+    ''' Returns the derivatives of G_bloch(x) with respect to each parameter
+        in x = [a,b,c].
+        Output - x.shape[:-1]+(3,DIM,DIM,4) real ndarray
+    '''
+    a, b, c = x[...,0], x[...,1], x[...,2]
+    ca, sa = np.cos(a), np.sin(a)
+    cb, sb = np.cos(b), np.sin(b)
+    cc, sc = np.cos(c), np.sin(c)
+    zero = np.zeros(np.shape(a))
+    n0 = [zero, zero, zero, zero]
+
+    dn_da = [[n0, [zero, -cb*sa, cb*ca, zero]],
+             [[zero, -sb*cc*sa+sc*ca, sb*cc*ca+sc*sa, zero],
+              [zero, -sb*sc*sa-cc*ca, sb*sc*ca-cc*sa, zero]]]
+    dn_db = [[n0, [zero, -sb*ca, -sb*sa, -cb]],
+             [[zero, cb*cc*ca, cb*cc*sa, -sb*cc],
+              [zero, cb*sc*ca, cb*sc*sa, -sb*sc]]]
+    dn_dc = [[n0, n0],
+             [[zero, -sb*sc*ca+cc*sa, -sb*sc*sa-cc*ca, -cb*sc],
+              [zero, sb*cc*ca+sc*sa, sb*cc*sa-sc*ca, cb*cc]]]
+    return np.moveaxis(np.array([dn_da,dn_db,dn_dc]), [0,1,2,3],
+                       [-4,-3,-2,-1])
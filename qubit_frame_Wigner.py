@@ -1,5 +1,6 @@
 import autograd.numpy as np
 import itertools as it
+from frame_cache import(frame_cache)
 
 DIM = 2
 x0 = [1.,1/2,1/2]
@@ -16,12 +17,69 @@ def power(a, p):
     else:
         return np.dot(a, power(a, (p-1)))
 
+@frame_cache
 def F(x):
     return get_F1q_list(x2Gamma(x))/DIM
 
+@frame_cache
 def G(x):
     return get_G1q_list(x2Gamma(x))
 
+def dF(x):
+    ''' Returns the derivatives of F(x) with respect to each parameter in x.
+        Output - (3,DIM,DIM,DIM,DIM) complex ndarray
+    '''
+    traces = get_trace_D(x2Gamma(x))
+    dF_list = []
+    for dGamma in dGamma_list:
+        dtraces = -get_trace_D(dGamma)/traces**2
+        dF1q0 = 1./DIM * np.einsum('ij,ijkl->kl', dtraces, D1q_list)
+        dF_list.append(np.einsum('ijkl,lm,ijnm->ijkn', D1q_list, dF1q0,
+                                 D1q_list.conj()))
+    return np.array(dF_list)/DIM
+
+def dG(x):
+    ''' Returns the derivatives of G(x) with respect to each parameter in x
+        (G is linear in Gamma).
+        Output - (3,DIM,DIM,DIM,DIM) complex ndarray
+    '''
+    return np.array([get_G1q_list(dGamma) for dGamma in dGamma_list])
+
+def F_bloch(x):
+    ''' Returns the coefficients of F(x) in the Pauli basis,
+        F_{ij} = sum_mu f_{ij,mu} sigma_mu with sigma_0 = 1, in closed form:
+        F_{p,q} = 1/DIM^2 sum_{p',q'} D_{p,q} D_{p',q'} D_{-p,-q}
+        / tr[D_{p',q'} Gamma], where the traces are linear in x.
+        x may carry leading batch axes.
+        Output - x.shape[:-1]+(DIM,DIM,4) real ndarray
+    '''
+    traces = trace_D0 + np.tensordot(x, trace_D_lin, axes=([-1],[0]))
+    return np.real(np.tensordot(1./traces, F_bloch_lin, axes=([-2,-1],
+                                                             [2,3])))
+
+def G_bloch(x):
+    ''' Returns the coefficients of G(x) in the Pauli basis (see F_bloch),
+        which are linear in x.
+        Output - x.shape[:-1]+(DIM,DIM,4) real ndarray
+    '''
+    return G_bloch0 + np.tensordot(x, G_bloch_lin, axes=([-1],[0]))
+
+def dF_bloch(x):
+    ''' Returns the derivatives of F_bloch(x) with respect to each parameter
+        in x.
+        Output - x.shape[:-1]+(3,DIM,DIM,4) real ndarray
+    '''
+    traces = trace_D0 + np.tensordot(x, trace_D_lin, axes=([-1],[0]))
+    dtraces = -trace_D_lin/traces[...,None,:,:]**2
+    return np.real(np.tensordot(dtraces, F_bloch_lin, axes=([-2,-1],[2,3])))
+
+def dG_bloch(x):
+    ''' Returns the derivatives of G_bloch(x) with respect to each parameter
+        in x.
+        Output - x.shape[:-1]+(3,DIM,DIM,4) real ndarray
+    '''
+    return np.broadcast_to(G_bloch_lin, np.shape(x)[:-1]+G_bloch_lin.shape)
+
 def x2Gamma(x):
     ''' Returns covariance matrix Gamma given array x of independent parameters
         with len(x) = 3 (Gamma is Hermitian with unit trace).
@@ -32,6 +90,11 @@ def x2Gamma(x):
     return np.array([[ x[0],             x[1] - 1.j*x[2]],
                      [ x[1] + 1.j*x[2],  1-x[0],         ]], dtype="complex_")
 
+# Derivatives of x2Gamma with respect to x[0], x[1], x[2]
+dGamma_list = np.array([[[1, 0],   [0,  -1]],
+                        [[0, 1],   [1,   0]],
+                        [[0, -1.j],[1.j, 0]]], dtype="complex_")
+
 def get_trace_D(Gamma):
     ''' Returns traces tr[D_{p,q} Gamma] at all phase points x.
         Output - (DIM,DIM) complex ndarray
@@ -86,3 +149,21 @@ def allD1qs():
     return D1q_list
 D1q_list = allD1qs()
 
+sigma_list = np.array([[[1,0],[0,1]], [[0,1],[1,0]], [[0,-1.j],[1.j,0]],
+                       [[1,0],[0,-1]]], dtype="complex_")
+def pauli_coefficients(A):
+    ''' Returns the coefficients c_mu of A = sum_mu c_mu sigma_mu in the
+        Pauli basis, over the last two axes of A.
+        Output - A.shape[:-2]+(4,) complex ndarray
+    '''
+    return np.einsum('mlk,...kl->...m', sigma_list, A)/2
+
+# Constant tensors of the closed-form F_bloch, G_bloch
+Gamma0 = x2Gamma([0,0,0])
+trace_D0 = get_trace_D(Gamma0)
+trace_D_lin = np.array([get_trace_D(dGamma) for dGamma in dGamma_list])
+G_bloch0 = np.real(pauli_coefficients(get_G1q_list(Gamma0)))
+G_bloch_lin = np.real(pauli_coefficients(np.array([get_G1q_list(dGamma)
+                                         for dGamma in dGamma_list])))
+F_bloch_lin = pauli_coefficients(np.einsum('ijkl,abln,ijmn->ijabkm',
+               D1q_list, D1q_list, D1q_list.conj()))/DIM**2
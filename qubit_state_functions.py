@@ -51,6 +51,17 @@ def psi2rho(psi):
         raise Exception('The trace of the state is {0:.2f}'.format(
                          np.trace(rho)))
 
+def rho2psi(rho):
+    ''' Converts a pure density operator rho (2d numpy array) to a state
+    vector (1d numpy array), up to a global phase.
+    '''
+    eigvals, eigvecs = np.linalg.eigh(np.array(rho))
+    if np.isclose(eigvals[-1], 1):
+        return eigvecs[:,-1]
+    else:
+        raise Exception('The state is not pure (largest eigenvalue '+
+                        '{0:.2f})'.format(eigvals[-1]))
+
 def maxmixed(n):
     return 1/n * np.eye(n)
 
@@ -7,7 +7,7 @@ import os
 
 from qubit_circuit_components import(makeState, makeGate)
 from compression import(compress_circuit)
-from frame_opt import(neg_gate_max)
+from frame_opt import(neg_gate_max_batch)
 from phase_space import(PhaseSpace)
 from qubit_frame_Pauli import(F, G, DIM, x0)
 ps_Pauli = PhaseSpace(F,G,x0,DIM)
@@ -70,9 +70,13 @@ def generate_data(N, n, L, T, S):
         cc = circuit.copy()
         cc = compress_circuit(cc, n)
         neg_cc = 1
+        arity_groups = {}
         for gate in cc['gate_list']:
-            params = int(np.log2(len(gate)))*[x0]
-            neg_cc *= neg_gate_max(ps_Pauli.W_gate, gate, params, params)
+            arity_groups.setdefault(int(np.log2(len(gate))), []).append(gate)
+        for n_g, gates in arity_groups.items():
+            params = len(gates)*[n_g*[x0]]
+            neg_cc *= np.prod(neg_gate_max_batch(ps_Pauli.W_gate_batch,
+                                np.stack(gates), params, params))
         data[s] = neg_cc
         np.save(fname, data)
     return np.array(data)
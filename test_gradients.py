@@ -0,0 +1,112 @@
+import numpy as onp
+import autograd.numpy as np
+from autograd import grad
+
+import qubit_frame_Pauli as Pauli
+import qubit_frame_Wigner as Wigner
+from phase_space import(PhaseSpace)
+from frame_opt import(init_x_list, get_target_circuit_block,
+                      get_connected_index, replace_x_list,
+                      get_negativity_block, get_negativity_block_grad)
+from qubit_circuit_components import(makeState, makeGate)
+from qubit_circuit_generator import(qr_haar)
+
+''' Checks the analytic gradients PhaseSpace.dW and get_negativity_block_grad
+    against autograd, for 1-3 qubit gates, states and measurements in both
+    qubit frames, with and without the closed-form Pauli-basis frames.
+    Run with python test_gradients.py (or pytest test_gradients.py).
+'''
+
+def get_phase_spaces():
+    ps_list = []
+    for M in [Pauli, Wigner]:
+        bloch_funs = [M.F_bloch, M.G_bloch, M.dF_bloch, M.dG_bloch]
+        ps_list.append((M.__name__, PhaseSpace(M.F, M.G, M.x0, M.DIM, M.dF,
+                                               M.dG)))
+        ps_list.append((M.__name__+' (bloch)', PhaseSpace(M.F, M.G, M.x0,
+                        M.DIM, M.dF, M.dG, bloch_funs)))
+    return ps_list
+
+def neg_gate(ps, gate, x_in, x_out):
+    n = len(x_in)
+    W = np.reshape(ps.W_gate(gate, list(x_in), list(x_out)), (4**n, -1))
+    return np.max(np.sum(np.abs(W), axis=1))
+
+def test_dW_gate():
+    onp.random.seed(1)
+    gates = [qr_haar(2), qr_haar(4), qr_haar(8), makeGate('H'),
+             makeGate('C+'), makeGate('HTK')]
+    for name, ps in get_phase_spaces():
+        for gate in gates:
+            n = int(onp.log2(len(gate)))
+            # Random frames, and x0 where Cliffords have many tied rows
+            for x_in, x_out in [(onp.random.rand(n,3), onp.random.rand(n,3)),
+                                (onp.array(n*[ps.x0], dtype=float),
+                                 onp.array(n*[ps.x0], dtype=float))]:
+                neg, grad_in, grad_out = ps.dW_gate(gate, list(x_in),
+                                                    list(x_out))
+                assert onp.isclose(neg, neg_gate(ps, gate, x_in, x_out)), name
+                assert onp.allclose(grad_in, grad(lambda x: neg_gate(ps,
+                                    gate, x, x_out))(x_in)), name
+                assert onp.allclose(grad_out, grad(lambda x: neg_gate(ps,
+                                    gate, x_in, x))(x_out)), name
+
+def test_dW_gate_batch():
+    onp.random.seed(4)
+    gates = onp.array([qr_haar(4), makeGate('C+'), makeGate('HT'),
+                       qr_haar(4)])
+    x_in, x_out = onp.random.rand(4,2,3), onp.random.rand(4,2,3)
+    for name, ps in get_phase_spaces():
+        neg, grad_in, grad_out = ps.dW_gate_batch(gates, x_in, x_out,
+                                                  chunk=2**9)
+        for b in range(len(gates)):
+            result = ps.dW_gate(gates[b], list(x_in[b]), list(x_out[b]))
+            assert onp.isclose(neg[b], result[0]), name
+            assert onp.allclose(grad_in[b], result[1]), name
+            assert onp.allclose(grad_out[b], result[2]), name
+
+def test_dW_state_meas():
+    onp.random.seed(2)
+    rho = onp.array([[0.7, 0.2+0.1j], [0.2-0.1j, 0.3]])
+    for name, ps in get_phase_spaces():
+        for state in [rho, makeState('0'), makeState('T')]:
+            for x in [onp.random.rand(3), onp.array(ps.x0, dtype=float)]:
+                neg, grad_state = ps.dW_state(state, x)
+                assert onp.allclose(grad_state, grad(lambda x: np.sum(
+                                    np.abs(ps.W_state(state, x))))(x)), name
+                neg, grad_meas = ps.dW_meas(state, x)
+                assert onp.allclose(grad_meas, grad(lambda x: np.max(
+                                    np.abs(ps.W_meas(state, x))))(x)), name
+
+def test_negativity_block_grad():
+    onp.random.seed(3)
+    circuit = {'state_list': [makeState('0'), makeState('T'), makeState('0')],
+               'gate_list': [qr_haar(4), makeGate('C+'), qr_haar(2),
+                             qr_haar(8), makeGate('T')],
+               'index_list': [[0,1], [1,2], [0], [2,0,1], [1]],
+               'meas_list': [makeState('0'), makeState('0'), np.eye(2)]}
+    for name, ps in get_phase_spaces():
+        x_circuit = init_x_list(circuit, ps.x0)
+        x_list = x_circuit['x_list'] + 0.1*onp.random.rand(
+                                           *x_circuit['x_list'].shape)
+        x_circuit = dict(x_circuit, x_list=x_list)
+        target = get_target_circuit_block(x_circuit, onp.arange(2,7))
+        idx = get_connected_index(x_circuit, target)
+
+        def cost_function(x):
+            x_replaced = replace_x_list(x_list, np.reshape(x, (-1,3)), idx)
+            return get_negativity_block(ps.W, circuit,
+                                        dict(x_circuit, x_list=x_replaced),
+                                        target)
+        neg, neg_grad = get_negativity_block_grad(ps.dW, circuit, x_circuit,
+                                                  target)
+        x = x_list[idx].flatten()
+        assert onp.isclose(neg, cost_function(x)), name
+        assert onp.allclose(neg_grad[idx].flatten(), grad(cost_function)(x)
+                            ), name
+
+if __name__ == '__main__':
+    for test in [test_dW_gate, test_dW_gate_batch, test_dW_state_meas,
+                 test_negativity_block_grad]:
+        test()
+        print(test.__name__, 'passed')
@@ -7,12 +7,14 @@ import matplotlib.pylab as plt
 from compression import(compress_circuit)
 from frame_opt import(init_x_list, get_negativity_circuit, sequential_para_opt)
 from phase_space import(PhaseSpace)
-from prob_sample import(prepare_sampler, sample_fast)
+from prob_sample import(prepare_sampler, sample_parallel)
 from qubit_circuit_components import(makeState, makeGate)
-from qubit_circuit_generator import(qiskit_simulate, show_connectivity,
+from qubit_circuit_generator import(statevector_simulate, show_connectivity,
                                     haar_random_connected_circuit)
-from qubit_frame_Wigner import(F, G, DIM, x0)
-# from qubit_frame_Pauli import(F, G, DIM, x0)
+from qubit_frame_Wigner import(F, G, DIM, x0, dF, dG, F_bloch, G_bloch,
+                               dF_bloch, dG_bloch)
+# from qubit_frame_Pauli import(F, G, DIM, x0, dF, dG, F_bloch, G_bloch,
+#                                dF_bloch, dG_bloch)
 
 
 plt.rcParams['figure.dpi'] = 200
@@ -25,20 +27,22 @@ plt.rc('legend',  fontsize=23)
 plt.rc('lines',  linewidth=2 )
 plt.rc('lines', markersize=5 )
 
-ps_Wigner = PhaseSpace(F, G, x0, DIM)
+ps_Wigner = PhaseSpace(F, G, x0, DIM, dF, dG,
+                       [F_bloch, G_bloch, dF_bloch, dG_bloch])
 x0 = ps_Wigner.x0
 W = ps_Wigner.W
 
 def sample(circuit, n, l, sample_size):
     circ      = deepcopy(circuit)
     circ_comp = compress_circuit(circuit, n)
-    prob      = qiskit_simulate(circ_comp)
+    prob      = statevector_simulate(circ_comp)
 
     x_in      = init_x_list(circ, x0)
     x_comp    = init_x_list(circ_comp, x0)
     print("---------------------")
     print("Calculating x_opt...")
-    x_opt, _  = sequential_para_opt(W, circ_comp, x_comp, l, niter=1)
+    x_opt, _  = sequential_para_opt(W, circ_comp, x_comp, l, niter=1,
+                                    dW=ps_Wigner.dW)
 
     label     = ['Comp: NO || Opt: NO',
                  'Comp: YES || Opt: NO',
@@ -49,17 +53,9 @@ def sample(circuit, n, l, sample_size):
     for i in range(3):
         print("---------------------")
         print(label[i])
-        meas_list, index_list, qd_list_states, qd_list_gates, qd_list_meas,\
-        pd_list_states, pd_list_gates, pd_list_meas, sign_list_states,\
-        sign_list_gates, sign_list_meas, neg_list_states, neg_list_gates,\
-        neg_list_meas = prepare_sampler(circuit=circuits[i], par_list=x[i],
-                                        ps=ps_Wigner)
-
-        estimate  = sample_fast(sample_size, meas_list, index_list,
-                    qd_list_states, qd_list_gates, qd_list_meas,
-                    pd_list_states, pd_list_gates, pd_list_meas,
-                    sign_list_states, sign_list_gates, sign_list_meas,
-                    neg_list_states, neg_list_gates, neg_list_meas)
+        sampler_args = prepare_sampler(circuit=circuits[i], par_list=x[i],
+                                       ps=ps_Wigner)
+        estimate  = sample_parallel(sample_size, *sampler_args)
         samples.append(estimate)
     return np.array(samples)
 